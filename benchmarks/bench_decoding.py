@@ -0,0 +1,60 @@
+import argparse
+import random
+import time
+
+import chardet
+
+from benchmarks.corpus import CHARSETS, make_html
+from mail_logic.decoding import CharsetDecoder
+
+# Запуск из корня проекта: python -m benchmarks.bench_decoding
+
+
+def make_corpus(size: int, seed: int = 1):
+    # Как в реальной почте: большая часть писем с указанной кодировкой, часть без нее
+    rnd = random.Random(seed)
+    corpus = []
+    for index in range(size):
+        charset = rnd.choice(CHARSETS)
+        content = make_html(rnd.choice([20, 200, 2000]), rnd).encode(charset)
+        declared = charset if index % 5 else None
+        corpus.append((content, declared, f"sender{index % 20}@example.com"))
+    return corpus
+
+
+def decode_with_chardet(content: bytes) -> str:
+    # Прежний способ: chardet по всему содержимому каждого письма
+    enc = chardet.detect(content)
+    encoding = enc["encoding"]
+    if enc["confidence"] < 0.5:
+        encoding = "utf-8"
+    return content.decode(encoding=encoding)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение декодирования тела письма: chardet и CharsetDecoder")
+    parser.add_argument("--size", type=int, default=300)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.size)
+    total_mb = sum(len(content) for content, _, _ in corpus) / 1024 / 1024
+
+    start = time.perf_counter()
+    for content, _, _ in corpus:
+        decode_with_chardet(content)
+    chardet_time = time.perf_counter() - start
+
+    decoder = CharsetDecoder()
+    start = time.perf_counter()
+    for content, declared, sender in corpus:
+        decoder.decode(content, declared, sender=sender)
+    decoder_time = time.perf_counter() - start
+
+    print(f"Писем: {len(corpus)}, {total_mb:.1f} MB")
+    print(f"chardet по всему телу: {chardet_time:.3f} s")
+    print(f"CharsetDecoder:        {decoder_time:.3f} s")
+    print(f"Ускорение: x{chardet_time / max(decoder_time, 1e-9):.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from multiprocessing.managers import BaseManager
+from typing import Callable, List
+
+from benchmarks.bench_pipeline import RESULTS_PATH, get_git_info
+from benchmarks.corpus import make_corpus
+from benchmarks.imap_server import LocalImapServer
+from benchmarks.memory_db import MemoryDatabase
+from common.config_controller import Config
+from mail_logic.daemon import Daemon
+from mail_logic.mail_logic import MailFacade
+from mail_logic.profile import ConfigProfile
+
+# Запуск из корня проекта: python -m benchmarks.bench_leases --nodes 3 --folders 6 --size 200
+# Несколько экземпляров daemon в отдельных процессах делят папки локального IMAP сервера через аренды.
+# Вместо MongoDB - общий MemoryDatabase в процессе multiprocessing.Manager. Посреди выгрузки один узел
+# убивается (SIGKILL): его папки должны перейти к другим узлам после истечения аренды, без потерь и повторов писем
+
+UIDVALIDITY = 1
+
+
+class DatabaseManager(BaseManager):
+    pass
+
+
+DatabaseManager.register("MemoryDatabase", MemoryDatabase)
+
+
+class SharedDatabase:
+    # Прокси Manager'а передает только вызовы методов, а MailFacade читает еще и bulk_batch_size
+    def __init__(self, proxy, bulk_batch_size: int = 100):
+        self._proxy = proxy
+        self.bulk_batch_size = bulk_batch_size
+
+    def __getattr__(self, name: str):
+        return getattr(self._proxy, name)
+
+
+def make_profile(port: int, folder: str, max_connections: int) -> ConfigProfile:
+    return ConfigProfile(source={"folder": folder,
+                                 "imap_host": "127.0.0.1",
+                                 "port": port,
+                                 "ssl": False,
+                                 "login": "bench",
+                                 "password": "bench",
+                                 "max_connections": max_connections},
+                         schedule={"use_idle": False, "poll_interval_sec": 1},
+                         image={"force_to_image": False},
+                         filters={"receiver_regex_mask": "@example.com", "restricted_subjects_regex": ["^re:"]},
+                         extra_fields={})
+
+
+def run_node(node_id: str, profiles: List[ConfigProfile], db_proxy, attachments_path: str, ttl_sec: float,
+             heartbeat_sec: float):
+    conf = Config()
+    conf.attachment_path = attachments_path
+    conf.data["coordination"] = {"enabled": True, "node_id": node_id, "lease_ttl_sec": ttl_sec,
+                                 "heartbeat_sec": heartbeat_sec}
+    Daemon(profiles, db_conn=SharedDatabase(db_proxy)).run()
+
+
+def wait_for(condition: Callable[[], bool], timeout: float, what: str):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Не дождались: {what}")
+        time.sleep(0.1)
+
+
+def count_expected(server: LocalImapServer, profiles: List[ConfigProfile], attachments_path: str) -> int:
+    # Эталон: те же папки одним процессом без аренд
+    Config().attachment_path = attachments_path
+    db = MemoryDatabase()
+    for profile in profiles:
+        db.commit_offset(profile.key, profile.folder, 0, UIDVALIDITY)
+        facade = MailFacade(profile, db_conn=db)
+        try:
+            facade.process_new_mail()
+        finally:
+            facade.close()
+    return len(db.mails)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Несколько узлов daemon с арендами на локальном IMAP сервере")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--folders", type=int, default=6)
+    parser.add_argument("--size", type=int, default=200, help="писем в каждой папке, половина приходит после сбоя")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--ttl-sec", type=float, default=3)
+    parser.add_argument("--heartbeat-sec", type=float, default=1)
+    parser.add_argument("--timeout-sec", type=float, default=120)
+    parser.add_argument("--output", help="путь для сохранения результата в json")
+    args = parser.parse_args()
+
+    os.makedirs(RESULTS_PATH, exist_ok=True)
+    Config()
+
+    corpus = make_corpus(args.size, seed=args.seed)
+    first_half, second_half = corpus[:len(corpus) // 2], corpus[len(corpus) // 2:]
+    server = LocalImapServer().start()
+    folders = [f"BENCH{number}" for number in range(args.folders)]
+    mailboxes = [server.add_mailbox(folder, first_half, uidvalidity=UIDVALIDITY) for folder in folders]
+    profiles = [make_profile(server.port, folder, max_connections=args.folders) for folder in folders]
+    profile_keys = [f"profile:{profile.key}" for profile in profiles]
+
+    work_path = tempfile.mkdtemp(prefix="mail_bench_leases_")
+    manager = DatabaseManager()
+    manager.start()
+    db = manager.MemoryDatabase()
+    for profile in profiles:
+        db.commit_offset(profile.key, profile.folder, 0, UIDVALIDITY)
+
+    node_ids = [f"node{number}" for number in range(args.nodes)]
+    nodes = {node_id: multiprocessing.Process(target=run_node, name=node_id,
+                                              args=(node_id, profiles, db, os.path.join(work_path, node_id),
+                                                    args.ttl_sec, args.heartbeat_sec))
+             for node_id in node_ids}
+    started = time.perf_counter()
+
+    def owners() -> dict:
+        leases = db.get_stats()["leases"]
+        return {key: leases.get(key) for key in profile_keys}
+
+    def is_balanced(live: List[str]) -> bool:
+        held = list(owners().values())
+        share = -(-len(profile_keys) // len(live))
+        return all(owner in live for owner in held) and all(held.count(node_id) <= share for node_id in live)
+
+    def is_finished() -> bool:
+        offsets = db.get_stats()["offsets"]
+        return all(offsets.get(profile.key) == mailbox.next_uid - 1 for profile, mailbox in zip(profiles, mailboxes))
+
+    try:
+        for node in nodes.values():
+            node.start()
+        wait_for(lambda: is_balanced(node_ids), args.timeout_sec, "распределение папок между узлами")
+        balanced_sec = time.perf_counter() - started
+        owners_before = owners()
+
+        # Убиваем узел, у которого есть папки; его аренды не освобождаются и должны истечь
+        victim = next(owner for owner in owners_before.values() if owner is not None)
+        nodes[victim].kill()
+        nodes[victim].join()
+        killed_at = time.perf_counter()
+        for mailbox in mailboxes:
+            for raw in second_half:
+                mailbox.append(raw)
+
+        live = [node_id for node_id in node_ids if node_id != victim]
+        wait_for(lambda: is_balanced(live) and None not in owners().values(), args.timeout_sec,
+                 "переход папок упавшего узла")
+        takeover_sec = time.perf_counter() - killed_at
+        wait_for(is_finished, args.timeout_sec, "выгрузку всех писем")
+        seconds = time.perf_counter() - started
+        stats = db.get_stats()
+        owners_after = owners()
+    finally:
+        for node in nodes.values():
+            if node.is_alive():
+                node.terminate()
+        for node in nodes.values():
+            node.join()
+        manager.shutdown()
+
+    try:
+        expected = count_expected(server, profiles, os.path.join(work_path, "expected"))
+    finally:
+        server.stop()
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    result = {"benchmark": "leases",
+              "started_at": datetime.now().isoformat(timespec="seconds"),
+              "git": get_git_info(),
+              "params": {"nodes": args.nodes,
+                         "folders": args.folders,
+                         "size": args.size,
+                         "seed": args.seed,
+                         "ttl_sec": args.ttl_sec,
+                         "heartbeat_sec": args.heartbeat_sec},
+              "seconds": round(seconds, 3),
+              "balanced_sec": round(balanced_sec, 3),
+              "killed_node": victim,
+              "takeover_sec": round(takeover_sec, 3),
+              "mails_expected": expected,
+              "mails_saved": stats["mails"],
+              "already_stored": stats["already_stored"],
+              "mails_failed": stats["failed_mails"],
+              "owners_before": owners_before,
+              "owners_after": owners_after}
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(result, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
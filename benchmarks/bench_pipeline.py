@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Callable, List, Optional
+
+from benchmarks.corpus import make_corpus
+from benchmarks.imap_server import LocalImapServer
+from benchmarks.memory_db import MemoryDatabase
+from common.config_controller import Config
+from mail_logic.mail_logic import EmailConnection, MailFacade, MailTask
+from mail_logic.pipeline import OffsetTracker
+from mail_logic.profile import ConfigProfile
+
+# Запуск из корня проекта: python -m benchmarks.bench_pipeline --size 500 --output benchmarks/results/<commit>.json
+# Настройки конвейера, рендера и логирования берутся из benchmarks/application.yaml.
+# Корпус детерминирован (--size, --seed), поэтому результаты разных коммитов можно сравнивать: --compare <json>
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_PATH = os.path.join(ROOT_PATH, "benchmarks", "results")
+FOLDER = "BENCH"
+UIDVALIDITY = 1
+MB = 1024 * 1024
+
+
+def get_git_info() -> dict:
+    def git(*args) -> str:
+        return subprocess.run(["git", *args], cwd=ROOT_PATH, capture_output=True, text=True, check=True).stdout.strip()
+
+    try:
+        return {"commit": git("rev-parse", "HEAD"),
+                "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+
+
+def get_peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    # На Linux ru_maxrss в килобайтах
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def make_profile(port: int, fetch_batch_size: int, force_to_image: bool) -> ConfigProfile:
+    return ConfigProfile(source={"folder": FOLDER,
+                                 "imap_host": "127.0.0.1",
+                                 "port": port,
+                                 "ssl": False,
+                                 "login": "bench",
+                                 "password": "bench",
+                                 "fetch_batch_size": fetch_batch_size},
+                         image={"force_to_image": force_to_image, "max_width_px": 800, "max_height_px": 1400},
+                         filters={"receiver_regex_mask": "@example.com", "restricted_subjects_regex": ["^re:"]},
+                         extra_fields={})
+
+
+def make_facade(profile: ConfigProfile, db: MemoryDatabase, attachments_path: str) -> MailFacade:
+    Config().attachment_path = attachments_path
+    # Без оффсета первый запуск считает все письма прочитанными, поэтому начинаем с нуля
+    db.commit_offset(profile.key, FOLDER, 0, UIDVALIDITY)
+    # Пул рендера создается фасадом и закрывается в close()
+    return MailFacade(profile, db_conn=db)
+
+
+def run_end_to_end(server: LocalImapServer, profile: ConfigProfile, db: MemoryDatabase, attachments_path: str,
+                   messages: int) -> dict:
+    facade = make_facade(profile, db, attachments_path)
+    server.reset_counters()
+    started = time.perf_counter()
+    try:
+        facade.process_new_mail()
+    finally:
+        facade.close()
+    seconds = time.perf_counter() - started
+
+    return {"seconds": round(seconds, 3),
+            "messages_per_sec": round(messages / seconds, 1),
+            "bytes_fetched": server.reset_counters(),
+            "mails_saved": len(db.mails),
+            "mails_failed": len(db.failed_mails),
+            "render_failed": sum(1 for mail in db.mails.values() if mail.get("render_failed")),
+            "db_requests": db.requests,
+            "pipeline_stages": facade.stage_stats,
+            "peak_rss_mb": get_peak_rss_mb()}
+
+
+def run_stages(server: LocalImapServer, profile: ConfigProfile, db: MemoryDatabase, attachments_path: str) -> dict:
+    # Этапы по очереди на всех письмах сразу: время и пик памяти (tracemalloc) каждого этапа отдельно
+    facade = make_facade(profile, db, attachments_path)
+    facade._offsets = OffsetTracker(0)
+    results = {}
+
+    def measure(name: str, func: Callable):
+        server.reset_counters()
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        started = time.perf_counter()
+        value = func()
+        seconds = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        results[name] = {"seconds": round(seconds, 3),
+                         "peak_mb": round((peak - before) / MB, 2),
+                         "bytes_fetched": server.reset_counters()}
+        return value
+
+    def each(handler: Callable, tasks: List[MailTask]) -> List[MailTask]:
+        done = []
+        for task in tasks:
+            try:
+                done.append(handler(task))
+            except Exception as e:
+                facade._on_stage_error("bench", task, e)
+        return done
+
+    tracemalloc.start()
+    connection = EmailConnection("127.0.0.1", "bench", "bench", port=server.port, use_ssl=False)
+    try:
+        uidvalidity, last_uid = measure("select", lambda: connection.select_folder(FOLDER))
+        facade.uidvalidity = uidvalidity
+        batches = measure("fetch_headers", lambda: [batch for _, batch in connection.iter_headers(
+                1, last_uid, FOLDER, batch_size=profile.fetch_batch_size)])
+        selected = measure("filter", lambda: [mail for batch in batches
+                                              for mail in facade._select_mails(uidvalidity, batch)])
+        tasks = measure("fetch_bodies", lambda: [MailTask(uid, raw_mail) for uid, raw_mail in connection.iter_bodies(
+                selected, FOLDER, force_to_image=profile.force_to_image, store=facade.attachment_store,
+                limits=facade.fetch_limits, on_error=facade._on_fetch_error)])
+        tasks = measure("build", lambda: each(facade._stage_build, tasks))
+        tasks = measure("attachments", lambda: each(facade._stage_attachments, tasks))
+        tasks = measure("render", lambda: each(facade._stage_render, tasks))
+        measure("save", lambda: facade._stage_save(tasks))
+    finally:
+        tracemalloc.stop()
+        connection.logout()
+        facade.close()
+    return results
+
+
+def compare(current: dict, previous_path: str):
+    with open(previous_path, encoding="utf-8") as file:
+        previous = json.load(file)
+    print(f"Сравнение с {previous['git']['commit']} ({previous_path}):")
+    rows = [("messages_per_sec", previous["end_to_end"]["messages_per_sec"],
+             current["end_to_end"]["messages_per_sec"])]
+    rows += [(f"{stage}.seconds", previous["stages"].get(stage, {}).get("seconds"), stats["seconds"])
+             for stage, stats in current["stages"].items()]
+    for name, before, after in rows:
+        change = f"x{after / before:.2f}" if before else "-"
+        print(f"  {name:<28} {before!s:>10} -> {after!s:<10} {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк MailFacade на локальном IMAP сервере и БД в памяти")
+    parser.add_argument("--size", type=int, default=300, help="количество писем в корпусе")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--fetch-batch-size", type=int, default=100)
+    parser.add_argument("--db-latency-ms", type=float, default=0, help="задержка каждого запроса к БД")
+    parser.add_argument("--no-render", action="store_true", help="не переводить html письма в картинки")
+    parser.add_argument("--output", help="путь для сохранения результата в json")
+    parser.add_argument("--compare", help="json предыдущего запуска для сравнения")
+    args = parser.parse_args()
+
+    os.makedirs(RESULTS_PATH, exist_ok=True)
+    Config()
+
+    corpus = make_corpus(args.size, seed=args.seed)
+    server = LocalImapServer().start()
+    server.add_mailbox(FOLDER, corpus, uidvalidity=UIDVALIDITY)
+    profile = make_profile(server.port, args.fetch_batch_size, force_to_image=not args.no_render)
+    work_path = tempfile.mkdtemp(prefix="mail_bench_")
+    try:
+        end_to_end = run_end_to_end(server, profile, MemoryDatabase(write_latency_sec=args.db_latency_ms / 1000),
+                                    os.path.join(work_path, "end_to_end"), len(corpus))
+        stages = run_stages(server, profile, MemoryDatabase(write_latency_sec=args.db_latency_ms / 1000),
+                            os.path.join(work_path, "stages"))
+    finally:
+        server.stop()
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    result = {"benchmark": "pipeline",
+              "started_at": datetime.now().isoformat(timespec="seconds"),
+              "git": get_git_info(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "cpu_count": os.cpu_count(),
+              "params": {"size": args.size,
+                         "seed": args.seed,
+                         "fetch_batch_size": args.fetch_batch_size,
+                         "db_latency_ms": args.db_latency_ms,
+                         "render": not args.no_render},
+              "corpus": {"messages": len(corpus), "bytes": sum(len(raw) for raw in corpus)},
+              "end_to_end": end_to_end,
+              "stages": stages}
+
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(result, file, ensure_ascii=False, indent=2)
+    if args.compare:
+        compare(result, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import email
+import random
+from email import policy
+from email.message import EmailMessage
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+WORDS = ["Инцидент", "сервер", "недоступен", "отчет", "заявка", "время", "ответственный", "статус",
+         "alert", "CPU", "disk", "latency", "node-01", "OK", "FAILED"]
+CHARSETS = ["utf-8", "cp1251", "koi8-r"]
+RECEIVER = "support@example.com"
+# Доля писем каждого вида в корпусе
+KINDS = [("plain", 35), ("html_table", 30), ("attachments", 15), ("duplicate", 15), ("filtered", 5)]
+
+
+def make_html(rows: int, rnd: random.Random) -> str:
+    cells = "".join(f"<tr><td>{rnd.choice(WORDS)}</td><td>{rnd.choice(WORDS)} {rnd.randint(0, 10 ** 6)}</td></tr>"
+                    for _ in range(rows))
+    return f"<html><body><table>{cells}</table></body></html>"
+
+
+def make_text(lines: int, rnd: random.Random) -> str:
+    return "\n".join(" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 12))) for _ in range(lines))
+
+
+def _base_message(index: int, subject: str, date: datetime, receiver: str = RECEIVER) -> EmailMessage:
+    message = EmailMessage()
+    message["From"] = f"sender{index % 20}@example.com"
+    message["To"] = receiver
+    message["Subject"] = subject
+    message["Date"] = format_datetime(date)
+    message["Message-ID"] = f"<{index}@bench.local>"
+    return message
+
+
+def make_mail(index: int, kind: str, rnd: random.Random, date: datetime) -> EmailMessage:
+    charset = rnd.choice(CHARSETS)
+    subject = f"{rnd.choice(WORDS)} {index}"
+    if kind == "filtered":
+        message = _base_message(index, f"Re: {subject}", date, receiver="someone@other.org")
+        message.set_content(make_text(5, rnd), charset=charset)
+        return message
+
+    message = _base_message(index, subject, date)
+    if kind == "plain":
+        message.set_content(make_text(rnd.choice([5, 50, 500]), rnd), charset=charset)
+    elif kind == "html_table":
+        message.set_content(make_text(5, rnd), charset=charset)
+        message.add_alternative(make_html(rnd.choice([50, 500, 3000]), rnd), subtype="html", charset=charset)
+    elif kind == "attachments":
+        message.set_content(make_text(20, rnd), charset=charset)
+        for number in range(rnd.randint(3, 12)):
+            content = rnd.randbytes(rnd.choice([2 * 1024, 64 * 1024, 512 * 1024]))
+            message.add_attachment(content, maintype="application", subtype="octet-stream",
+                                   filename=f"report_{index}_{number}.bin")
+    return message
+
+
+def make_corpus(size: int, seed: int = 1) -> List[bytes]:
+    # Детерминированный корпус: при одинаковых size и seed письма совпадают байт в байт, что позволяет сравнивать
+    # результаты между коммитами. Дубликаты повторяют содержимое одного из предыдущих писем с новым Message-ID
+    rnd = random.Random(seed)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    kinds = [kind for kind, weight in KINDS for _ in range(weight)]
+    messages: List[EmailMessage] = []
+    for index in range(size):
+        kind = rnd.choice(kinds)
+        date = start + timedelta(minutes=index)
+        if kind == "duplicate" and messages:
+            message = _copy_with_new_id(rnd.choice(messages), index, date)
+        else:
+            message = make_mail(index, "plain" if kind == "duplicate" else kind, rnd, date)
+        # Иначе email генерирует случайные границы MIME и корпус меняется от запуска к запуску
+        for number, part in enumerate(message.walk()):
+            if part.is_multipart():
+                part.set_boundary(f"==bench-{index}-{number}==")
+        messages.append(message)
+    return [message.as_bytes(policy=policy.SMTP) for message in messages]
+
+
+def _copy_with_new_id(original: EmailMessage, index: int, date: datetime) -> EmailMessage:
+    message = email.message_from_bytes(original.as_bytes(policy=policy.SMTP), policy=policy.SMTP)
+    message.replace_header("Message-ID", f"<{index}@bench.local>")
+    message.replace_header("Date", format_datetime(date))
+    return message
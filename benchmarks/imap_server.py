@@ -0,0 +1,329 @@
+import datetime
+import email
+import email.utils
+import re
+import select
+import socketserver
+import threading
+from email.message import Message
+from typing import Dict, List, Optional, Tuple
+
+# Минимальный IMAP4rev1 сервер для бенчмарков: только команды, которые использует EmailConnection.
+# Без SSL, одна учетная запись, папки только для чтения
+
+_FETCH_ITEM_RE = re.compile(r"BODY(?:\.PEEK)?\[(?P<section>[^\]]*)\](?:<(?P<start>\d+)\.(?P<length>\d+)>)?"
+                            r"|UID|BODYSTRUCTURE|RFC822\.SIZE|RFC822|FLAGS|INTERNALDATE")
+_HEADER_FIELDS_RE = re.compile(r"HEADER\.FIELDS \((?P<names>[^)]*)\)")
+_MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def _quote(value: Optional[str]) -> str:
+    if value is None:
+        return "NIL"
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _literal(data: bytes) -> bytes:
+    return b"{" + str(len(data)).encode() + b"}\r\n" + data
+
+
+def _payload_bytes(part: Message) -> bytes:
+    if part.is_multipart():
+        return b""
+    payload = part.get_payload()
+    if isinstance(payload, bytes):
+        return payload
+    # get_payload() возвращает 8bit тело уже декодированным по charset части, кодируем его обратно
+    try:
+        return payload.encode(part.get_content_charset() or "ascii", errors="surrogateescape")
+    except (LookupError, UnicodeEncodeError):
+        return payload.encode("utf-8", errors="surrogateescape")
+
+
+class StoredMail:
+    def __init__(self, uid: int, raw: bytes):
+        self.uid = uid
+        self.raw = raw
+        self.message = email.message_from_bytes(raw)
+        self.header_end = raw.find(b"\r\n\r\n") + 4
+
+    @property
+    def date(self) -> datetime.date:
+        return email.utils.parsedate_to_datetime(self.message["Date"]).date()
+
+    def get_part(self, section: str) -> Message:
+        part = self.message
+        if not section:
+            return part
+        for number in section.split("."):
+            if part.is_multipart():
+                part = part.get_payload()[int(number) - 1]
+            elif number != "1":
+                raise KeyError(section)
+        return part
+
+    def get_section(self, section: str) -> bytes:
+        if section == "":
+            return self.raw
+        if section == "HEADER":
+            return self.raw[:self.header_end]
+        if section == "TEXT":
+            return self.raw[self.header_end:]
+        match = _HEADER_FIELDS_RE.fullmatch(section)
+        if match:
+            return self.get_header_fields(match.group("names").split())
+        return _payload_bytes(self.get_part(section))
+
+    def get_header_fields(self, names: List[str]) -> bytes:
+        names = {name.lower() for name in names}
+        lines = []
+        include = False
+        for line in self.raw[:self.header_end].split(b"\r\n"):
+            if line[:1] in (b" ", b"\t"):
+                if include:
+                    lines.append(line)
+                continue
+            include = line.split(b":", 1)[0].strip().lower().decode("ascii", "replace") in names
+            if include:
+                lines.append(line)
+        return b"\r\n".join(lines) + b"\r\n\r\n"
+
+    def body_structure(self, part: Message = None) -> str:
+        part = part if part is not None else self.message
+        if part.is_multipart():
+            children = "".join(self.body_structure(child) for child in part.get_payload())
+            return f"({children} {_quote(part.get_content_subtype().upper())})"
+
+        params = part.get_params(header="content-type")[1:] if part.get("Content-Type") else []
+        params_str = ("(" + " ".join(f"{_quote(key.upper())} {_quote(str(value))}" for key, value in params) + ")"
+                      if params else "NIL")
+        payload = _payload_bytes(part)
+        fields = [_quote(part.get_content_maintype().upper()), _quote(part.get_content_subtype().upper()), params_str,
+                  "NIL", "NIL", _quote(part.get("Content-Transfer-Encoding", "7BIT").upper()), str(len(payload))]
+        if part.get_content_maintype() == "text":
+            fields.append(str(payload.count(b"\n")))
+
+        disposition = "NIL"
+        if part.get_content_disposition() is not None:
+            filename = part.get_param("filename", header="content-disposition")
+            disposition_params = f"({_quote('FILENAME')} {_quote(str(filename))})" if filename else "NIL"
+            disposition = f"({_quote(part.get_content_disposition().upper())} {disposition_params})"
+        fields += ["NIL", disposition, "NIL", "NIL"]
+        return "(" + " ".join(fields) + ")"
+
+
+class Mailbox:
+    def __init__(self, name: str, uidvalidity: int = 1):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.mails: List[StoredMail] = []
+        self.next_uid = 1
+
+    def append(self, raw: bytes) -> int:
+        uid = self.next_uid
+        self.mails.append(StoredMail(uid, raw))
+        self.next_uid += 1
+        return uid
+
+
+def _parse_set(value: str, max_value: int) -> List[Tuple[int, int]]:
+    ranges = []
+    for item in value.split(","):
+        start, _, end = item.partition(":")
+        start = max_value if start == "*" else int(start)
+        end = start if not end else (max_value if end == "*" else int(end))
+        ranges.append((min(start, end), max(start, end)))
+    return ranges
+
+
+class ImapHandler(socketserver.StreamRequestHandler):
+    server: "LocalImapServer"
+
+    def handle(self):
+        self.selected: Optional[Mailbox] = None
+        self._send(b"* OK [CAPABILITY IMAP4rev1 IDLE] Local benchmark IMAP server ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, rest = line.decode("utf-8", "replace").rstrip("\r\n").partition(" ")
+            command, _, args = rest.partition(" ")
+            command = command.upper()
+            try:
+                if not self._dispatch(tag, command, args):
+                    return
+            except Exception as e:
+                self._send(f"{tag} BAD {type(e).__name__}: {e}\r\n".encode())
+
+    def _dispatch(self, tag: str, command: str, args: str) -> bool:
+        if command == "CAPABILITY":
+            self._send(b"* CAPABILITY IMAP4rev1 IDLE\r\n")
+        elif command == "LOGIN":
+            user, password = [value.strip('"') for value in args.split(" ", 1)]
+            if (user, password) != (self.server.login, self.server.password):
+                self._send(f"{tag} NO [AUTHENTICATIONFAILED] Invalid credentials\r\n".encode())
+                return True
+        elif command in ("SELECT", "EXAMINE"):
+            mailbox = self.server.mailboxes.get(args.strip('"'))
+            if mailbox is None:
+                self._send(f"{tag} NO Mailbox does not exist\r\n".encode())
+                return True
+            self.selected = mailbox
+            self._send(f"* {len(mailbox.mails)} EXISTS\r\n* 0 RECENT\r\n* FLAGS (\\Seen)\r\n"
+                       f"* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid\r\n"
+                       f"* OK [UIDNEXT {mailbox.next_uid}] Predicted next UID\r\n".encode())
+            self._send(f"{tag} OK [READ-ONLY] {command} completed\r\n".encode())
+            return True
+        elif command == "STATUS":
+            name, _, _ = args.partition(" ")
+            mailbox = self.server.mailboxes[name.strip('"')]
+            self._send(f"* STATUS {name} (MESSAGES {len(mailbox.mails)} UIDNEXT {mailbox.next_uid} "
+                       f"UIDVALIDITY {mailbox.uidvalidity})\r\n".encode())
+        elif command == "FETCH":
+            sequence_set, _, items = args.partition(" ")
+            self._fetch(sequence_set, items, by_uid=False)
+        elif command == "UID":
+            sub_command, _, sub_args = args.partition(" ")
+            if sub_command.upper() == "SEARCH":
+                self._search(sub_args)
+            elif sub_command.upper() == "FETCH":
+                sequence_set, _, items = sub_args.partition(" ")
+                self._fetch(sequence_set, items, by_uid=True)
+            else:
+                raise ValueError(f"UID {sub_command} не поддерживается")
+        elif command == "IDLE":
+            self._idle(tag)
+            return True
+        elif command == "CLOSE":
+            self.selected = None
+        elif command == "LOGOUT":
+            self._send(f"* BYE Logging out\r\n{tag} OK LOGOUT completed\r\n".encode())
+            return False
+        elif command != "NOOP":
+            self._send(f"{tag} BAD Unknown command {command}\r\n".encode())
+            return True
+        self._send(f"{tag} OK {command} completed\r\n".encode())
+        return True
+
+    def _fetch(self, sequence_set: str, items: str, by_uid: bool):
+        mails = self.selected.mails
+        if by_uid:
+            ranges = _parse_set(sequence_set, mails[-1].uid if mails else 0)
+            matched = [(seq, mail) for seq, mail in enumerate(mails, 1)
+                       if any(start <= mail.uid <= end for start, end in ranges)]
+        else:
+            ranges = _parse_set(sequence_set, len(mails))
+            matched = [(seq, mail) for seq, mail in enumerate(mails, 1)
+                       if any(start <= seq <= end for start, end in ranges)]
+
+        requested = [match for match in _FETCH_ITEM_RE.finditer(items)]
+        for seq, mail in matched:
+            response = [f"* {seq} FETCH (".encode()]
+            if by_uid and not any(match.group(0) == "UID" for match in requested):
+                response.append(f"UID {mail.uid} ".encode())
+            for match in requested:
+                response.append(self._fetch_item(mail, match))
+                response.append(b" ")
+            response[-1] = b")\r\n"
+            self._send(b"".join(response))
+
+    def _search(self, criteria: str):
+        # Только ALL, SINCE и BEFORE; дата получения письма - его заголовок Date
+        mails = self.selected.mails
+        tokens = criteria.upper().split()
+        while tokens:
+            key = tokens.pop(0)
+            if key == "ALL":
+                continue
+            if key not in ("SINCE", "BEFORE"):
+                raise ValueError(f"SEARCH {key} не поддерживается")
+            day, month, year = tokens.pop(0).strip('"').split("-")
+            value = datetime.date(int(year), _MONTHS.index(month.capitalize()) + 1, int(day))
+            mails = [mail for mail in mails if (mail.date >= value if key == "SINCE" else mail.date < value)]
+        self._send(" ".join(["* SEARCH"] + [str(mail.uid) for mail in mails]).encode() + b"\r\n")
+
+    @staticmethod
+    def _fetch_item(mail: StoredMail, match) -> bytes:
+        item = match.group(0)
+        if item == "UID":
+            return f"UID {mail.uid}".encode()
+        if item == "BODYSTRUCTURE":
+            return f"BODYSTRUCTURE {mail.body_structure()}".encode()
+        if item == "RFC822":
+            return b"RFC822 " + _literal(mail.raw)
+        if item == "RFC822.SIZE":
+            return f"RFC822.SIZE {len(mail.raw)}".encode()
+        if item == "FLAGS":
+            return b"FLAGS (\\Seen)"
+        if item == "INTERNALDATE":
+            return b'INTERNALDATE "01-Jan-2024 00:00:00 +0000"'
+
+        section = match.group("section")
+        data = mail.get_section(section)
+        name = f"BODY[{section}]"
+        if match.group("start") is not None:
+            start = int(match.group("start"))
+            data = data[start:start + int(match.group("length"))]
+            name += f"<{start}>"
+        return name.encode() + b" " + _literal(data)
+
+    def _idle(self, tag: str):
+        mailbox = self.selected
+        known = len(mailbox.mails) if mailbox is not None else 0
+        self._send(b"+ idling\r\n")
+        while True:
+            if select.select([self.connection], [], [], 0.2)[0]:
+                line = self.rfile.readline()
+                if not line or line.strip().upper() == b"DONE":
+                    break
+            if mailbox is not None and len(mailbox.mails) > known:
+                known = len(mailbox.mails)
+                self._send(f"* {known} EXISTS\r\n".encode())
+        self._send(f"{tag} OK IDLE terminated\r\n".encode())
+
+    def _send(self, data: bytes):
+        self.wfile.write(data)
+        self.server.count_bytes(len(data))
+
+
+class LocalImapServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, login: str = "bench", password: str = "bench", host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), ImapHandler)
+        self.login = login
+        self.password = password
+        self.mailboxes: Dict[str, Mailbox] = {}
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def add_mailbox(self, name: str, mails: List[bytes] = (), uidvalidity: int = 1) -> Mailbox:
+        mailbox = Mailbox(name, uidvalidity)
+        for raw in mails:
+            mailbox.append(raw)
+        self.mailboxes[name] = mailbox
+        return mailbox
+
+    def count_bytes(self, amount: int):
+        with self._lock:
+            self.bytes_sent += amount
+
+    def reset_counters(self) -> int:
+        with self._lock:
+            amount, self.bytes_sent = self.bytes_sent, 0
+        return amount
+
+    def start(self) -> "LocalImapServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="local-imap", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,154 @@
+import datetime
+import threading
+import time
+import traceback
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+class MemoryDatabase:
+    # Замена MongoDatabase в памяти для бенчмарков: те же методы, что использует MailFacade.
+    # write_latency_sec имитирует сетевую задержку каждого запроса к БД
+    def __init__(self, bulk_batch_size: int = 100, write_latency_sec: float = 0.0):
+        self.bulk_batch_size = bulk_batch_size
+        self.write_latency_sec = write_latency_sec
+        self.mails: Dict[str, dict] = {}
+        self.offsets: Dict[str, dict] = {}
+        self.backfill_checkpoints: Dict[str, dict] = {}
+        self.leases: Dict[str, dict] = {}
+        self.already_stored = 0
+        self.failed_mails: Dict[str, dict] = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _request(self):
+        # Задержка вне блокировки: запросы из разных потоков ждут параллельно, как с настоящим MongoClient
+        if self.write_latency_sec:
+            time.sleep(self.write_latency_sec)
+        with self._lock:
+            self.requests += 1
+
+    def get_existing_mail_ids(self, mail_ids: Iterable[str]) -> Set[str]:
+        mail_ids = list(mail_ids)
+        if not mail_ids:
+            return set()
+        self._request()
+        with self._lock:
+            return {mail_id for mail_id in mail_ids if mail_id in self.mails}
+
+    def save_mails(self, mails: List[dict]) -> Tuple[List[str], List[str], Dict[str, Exception]]:
+        inserted, already_stored = [], []
+        for start in range(0, len(mails), self.bulk_batch_size):
+            self._request()
+            with self._lock:
+                for mail in mails[start:start + self.bulk_batch_size]:
+                    if mail["id"] in self.mails:
+                        already_stored.append(mail["id"])
+                        self.already_stored += 1
+                    else:
+                        self.mails[mail["id"]] = mail
+                        inserted.append(mail["id"])
+        # Ограничений MongoDB на документы здесь нет, отклоненных писем не бывает
+        return inserted, already_stored, {}
+
+    def get_max_mail_uid(self, id_prefix: str) -> Optional[int]:
+        with self._lock:
+            uids = [mail_id[len(id_prefix):] for mail_id in self.mails if mail_id.startswith(id_prefix)]
+        return max((int(uid) for uid in uids if uid.isdigit()), default=None)
+
+    def get_offset(self, profile_key: str) -> Optional[dict]:
+        self._request()
+        with self._lock:
+            return self.offsets.get(profile_key)
+
+    def commit_offset(self, profile_key: str, folder: str, uid: int, uidvalidity: int) -> dict:
+        self._request()
+        with self._lock:
+            self.offsets[profile_key] = {"_id": profile_key,
+                                         "profile": profile_key,
+                                         "folder": folder,
+                                         "uid": uid,
+                                         "uidvalidity": uidvalidity,
+                                         "updated_at": datetime.datetime.now()}
+            return self.offsets[profile_key]
+
+    def get_legacy_offset(self, folder: str) -> Optional[dict]:
+        return None
+
+    def delete_legacy_offsets(self, folder: str):
+        pass
+
+    def get_backfill_checkpoint(self, shard_id: str) -> Optional[dict]:
+        self._request()
+        with self._lock:
+            return self.backfill_checkpoints.get(shard_id)
+
+    def commit_backfill_checkpoint(self, shard_id: str, profile_key: str, folder: str, first_uid: int, last_uid: int,
+                                   uid: int, uidvalidity: int) -> dict:
+        self._request()
+        with self._lock:
+            self.backfill_checkpoints[shard_id] = {"_id": shard_id,
+                                                   "profile": profile_key,
+                                                   "folder": folder,
+                                                   "first_uid": first_uid,
+                                                   "last_uid": last_uid,
+                                                   "uid": uid,
+                                                   "uidvalidity": uidvalidity,
+                                                   "done": uid >= last_uid,
+                                                   "updated_at": datetime.datetime.now()}
+            return self.backfill_checkpoints[shard_id]
+
+    def acquire_lease(self, key: str, owner: str, ttl_sec: float) -> Optional[dict]:
+        self._request()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            lease = self.leases.get(key)
+            if lease is not None and lease["owner"] != owner and lease["expires_at"] >= now:
+                return None
+            self.leases[key] = {"_id": key,
+                                "owner": owner,
+                                "expires_at": now + datetime.timedelta(seconds=ttl_sec),
+                                "renewed_at": now}
+            return self.leases[key]
+
+    def renew_lease(self, key: str, owner: str, ttl_sec: float) -> bool:
+        self._request()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            lease = self.leases.get(key)
+            if lease is None or lease["owner"] != owner:
+                return False
+            lease.update({"expires_at": now + datetime.timedelta(seconds=ttl_sec), "renewed_at": now})
+            return True
+
+    def release_lease(self, key: str, owner: str):
+        self._request()
+        with self._lock:
+            if key in self.leases and self.leases[key]["owner"] == owner:
+                del self.leases[key]
+
+    def count_leases(self, prefix: str) -> int:
+        self._request()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            return sum(1 for key, lease in self.leases.items() if key.startswith(prefix) and lease["expires_at"] >= now)
+
+    def get_stats(self) -> dict:
+        # Для общего экземпляра через multiprocessing.Manager: атрибуты прокси не видны, только методы
+        with self._lock:
+            return {"mails": len(self.mails),
+                    "already_stored": self.already_stored,
+                    "failed_mails": len(self.failed_mails),
+                    "requests": self.requests,
+                    "offsets": {key: offset["uid"] for key, offset in self.offsets.items()},
+                    "leases": {key: lease["owner"] for key, lease in self.leases.items()}}
+
+    def record_failed_mail(self, profile_key: str, mail_id: str, uid: int, error: Exception):
+        self._request()
+        with self._lock:
+            failed = self.failed_mails.setdefault(mail_id, {"_id": mail_id, "attempts": 0})
+            failed.update({"profile": profile_key,
+                           "uid": uid,
+                           "error": repr(error),
+                           "traceback": "".join(traceback.format_exception(type(error), error, error.__traceback__)),
+                           "failed_at": datetime.datetime.now()})
+            failed["attempts"] += 1
@@ -1,27 +1,62 @@
+import json
 import os
+import re
 import sys
 from logging import Logger
-
-from dotenv import load_dotenv
-from pyaml_env import parse_config
+from typing import List, Optional
 import logging.handlers
 
 from common.utils import Singleton
 
+SNAPSHOT_FILE = ".application.snapshot.json"
+# Снимок другой версии (в том числе старого формата без version) считается промахом кэша
+SNAPSHOT_VERSION = 2
+# В снимке значение с тегом !ENV хранится как {"!ENV": "${VAR:default}"} и подставляется из окружения при загрузке
+_ENV_TAG = "!ENV"
+# Как в pyaml_env: ${VAR} или ${VAR:default}, без переменной и без значения по умолчанию - N/A
+_ENV_VAR_RE = re.compile(r"\$\{([^}{:]+)(?::([^}]+))?\}")
+_ENV_DEFAULT_VALUE = "N/A"
+_REQUIRED_PARAMS = (("database", "db_name"), ("database", "host"), ("database", "port"), ("profiles",),
+                    ("attachments", "path"), ("logging", "path"), ("logging", "backupCount"),
+                    ("logging", "maxMegaBytes"), ("logging", "loggers"))
+
 
 class Config(metaclass=Singleton):
     _allowed_logger_names = []
 
     def __init__(self):
-        load_dotenv(dotenv_path=self.get_abs_main_path(".env"), override=True)
-
-        self.data = parse_config(self.get_abs_main_path("./application.yaml"), encoding="utf-8")
+        self.data = self._load_data()
         self.profiles: dict = self.data["profiles"]
 
         self.attachment_path = self.data["attachments"]["path"]
         self._logging_init()
         sys.excepthook = logging_excepthook
 
+    def _load_data(self) -> dict:
+        # Разобранный application.yaml кэшируется в файле рядом с ним и используется, пока yaml не изменился.
+        # Значения !ENV в снимке не раскрыты (секреты остаются только в .env и окружении) и подставляются
+        # при каждой загрузке, поэтому pyaml_env и yaml при попадании в кэш не импортируются
+        from dotenv import load_dotenv
+
+        yaml_path = self.get_abs_main_path("./application.yaml")
+        snapshot_path = self.get_abs_main_path(SNAPSHOT_FILE)
+        source = _get_file_stamp(yaml_path)
+        load_dotenv(dotenv_path=self.get_abs_main_path(".env"), override=True)
+
+        snapshot = _read_snapshot(snapshot_path)
+        if snapshot is not None and snapshot["source"] == source:
+            return _resolve_env(snapshot["data"])
+
+        from pyaml_env import parse_config
+
+        data = parse_config(yaml_path, encoding="utf-8")
+        _validate(data)
+        raw_data = _load_unresolved(yaml_path)
+        # Раскрытие снимка должно давать ровно то же, что pyaml_env (например, без !ENV с !!int) - иначе без кэша
+        if _resolve_env(raw_data) == data:
+            _write_snapshot(snapshot_path, {"version": SNAPSHOT_VERSION, "source": source, "data": raw_data})
+        return data
+
     @staticmethod
     def get_abs_main_path(path_from_main_root: str):
         import __main__
@@ -75,6 +110,80 @@ class Config(metaclass=Singleton):
             self._allowed_logger_names.append(logger_name)
 
 
+def _get_file_stamp(path: str) -> Optional[List[int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _load_unresolved(yaml_path: str):
+    import yaml
+
+    class UnresolvedEnvLoader(yaml.SafeLoader):
+        pass
+
+    UnresolvedEnvLoader.add_constructor(_ENV_TAG, lambda loader, node: {_ENV_TAG: loader.construct_scalar(node)})
+    with open(yaml_path, encoding="utf-8") as file:
+        return yaml.load(file, Loader=UnresolvedEnvLoader)
+
+
+def _resolve_env(data):
+    if isinstance(data, dict):
+        if len(data) == 1 and _ENV_TAG in data:
+            return _ENV_VAR_RE.sub(lambda match: os.environ.get(match[1], match[2] or _ENV_DEFAULT_VALUE),
+                                   data[_ENV_TAG])
+        return {key: _resolve_env(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [_resolve_env(value) for value in data]
+    return data
+
+
+def _validate(data: dict):
+    for path in _REQUIRED_PARAMS:
+        value = data
+        for name in path:
+            if not isinstance(value, dict) or name not in value:
+                raise Exception(f"В application.yaml не задан параметр {'.'.join(path)}")
+            value = value[name]
+    if not isinstance(data["profiles"], list):
+        raise Exception("profiles в application.yaml должен быть списком")
+
+
+def _read_snapshot(path: str) -> Optional[dict]:
+    try:
+        with open(path, encoding="utf-8") as file:
+            snapshot = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    if "source" not in snapshot or not isinstance(snapshot.get("data"), dict):
+        return None
+    return snapshot
+
+
+def _write_snapshot(path: str, snapshot: dict):
+    try:
+        content = json.dumps(snapshot, ensure_ascii=False)
+    except (TypeError, ValueError):
+        return
+    # Значения, которые json не сохраняет как есть (даты, нестроковые ключи), - без кэша
+    if json.loads(content)["data"] != snapshot["data"]:
+        return
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
 def logging_excepthook(excType, excValue, traceback):
     Config.get_common_logger().error(
         "Logging an uncaught exception", exc_info=(excType, excValue, traceback)
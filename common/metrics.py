@@ -0,0 +1,210 @@
+import bisect
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from common.config_controller import Config
+from common.utils import Singleton
+
+PREFIX = "mail_exporter_"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_LabelsKey = Tuple[Tuple[str, str], ...]
+
+
+def _labels_key(labels: dict) -> _LabelsKey:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: _LabelsKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in items)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + "}"
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Timer:
+    def __init__(self, metrics: "Metrics", name: str, labels: dict):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+
+class _NoopTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+class Metrics(metaclass=Singleton):
+    # Счетчики, gauge и гистограммы времени шагов обработки в формате Prometheus.
+    # Выключенные метрики (metrics.enabled: false) сводятся к одной проверке флага
+    def __init__(self):
+        conf = Config().data.get("metrics") or {}
+        self.enabled = conf.get("enabled", False)
+        self.http_port = conf.get("http_port")
+        self.file_path = conf.get("file_path")
+        self.file_interval_sec = conf.get("file_interval_sec", 15)
+        self.log = Config.get_common_logger()
+
+        self._counters: Dict[str, Dict[_LabelsKey, float]] = {}
+        self._gauges: Dict[str, Dict[_LabelsKey, float]] = {}
+        self._histograms: Dict[str, Dict[_LabelsKey, _Histogram]] = {}
+        self._lock = threading.Lock()
+        self._http_server: Optional[ThreadingHTTPServer] = None
+        self._file_thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = _labels_key(labels)
+        with self._lock:
+            values = self._counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + amount
+
+    def set_gauge(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._gauges.setdefault(name, {})[_labels_key(labels)] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        if not self.enabled:
+            return
+        key = _labels_key(labels)
+        with self._lock:
+            values = self._histograms.setdefault(name, {})
+            if key not in values:
+                values[key] = _Histogram()
+            values[key].observe(seconds)
+
+    def timer(self, name: str, **labels):
+        return _Timer(self, name, labels) if self.enabled else _NOOP_TIMER
+
+    def timed_iter(self, iterator: Iterator, name: str, **labels) -> Iterator:
+        # Время получения каждого элемента генератора, например очередного UID FETCH
+        if not self.enabled:
+            return iterator
+        return self._timed_iter(iterator, name, labels)
+
+    def _timed_iter(self, iterator: Iterator, name: str, labels: dict) -> Iterator:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(name, time.perf_counter() - started, **labels)
+            yield item
+
+    def render(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            for name, values in sorted(self._counters.items()):
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                lines += [f"{PREFIX}{name}{_format_labels(key)} {value}" for key, value in values.items()]
+            for name, values in sorted(self._gauges.items()):
+                lines.append(f"# TYPE {PREFIX}{name} gauge")
+                lines += [f"{PREFIX}{name}{_format_labels(key)} {value}" for key, value in values.items()]
+            for name, values in sorted(self._histograms.items()):
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for key, histogram in values.items():
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{PREFIX}{name}_bucket{_format_labels(key, (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{PREFIX}{name}_sum{_format_labels(key)} {histogram.sum}")
+                    lines.append(f"{PREFIX}{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        if not self.enabled:
+            return
+        if self.http_port:
+            self._start_http()
+        if self.file_path:
+            self._file_thread = threading.Thread(target=self._write_file_periodically, name="metrics-file",
+                                                 daemon=True)
+            self._file_thread.start()
+
+    def close(self):
+        if not self.enabled:
+            return
+        self._stop_event.set()
+        if self._file_thread is not None:
+            self._file_thread.join()
+            self._file_thread = None
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+            self._http_server = None
+
+    def _start_http(self):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._http_server = ThreadingHTTPServer(("127.0.0.1", self.http_port), Handler)
+        except OSError as e:
+            # В режиме run на каждый ящик свой процесс, порт достается только первому
+            self.log.warning(f"Не удалось открыть порт метрик {self.http_port}: {e}")
+            return
+        self._http_server.daemon_threads = True
+        threading.Thread(target=self._http_server.serve_forever, name="metrics-http", daemon=True).start()
+        self.log.info(f"Метрики доступны на http://127.0.0.1:{self.http_port}/metrics")
+
+    def _write_file_periodically(self):
+        while not self._stop_event.wait(self.file_interval_sec):
+            self._write_file()
+        self._write_file()
+
+    def _write_file(self):
+        path = self.file_path.format(pid=os.getpid())
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            # Атомарная замена: сборщик не прочитает наполовину записанный файл
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                file.write(self.render())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self.log.warning(f"Не удалось записать метрики в {path}", exc_info=e)
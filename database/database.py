@@ -1,9 +1,13 @@
+import datetime
 import os
-
-from pymongo import MongoClient
+import re
+import traceback
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 from common.config_controller import Config
 
+DUPLICATE_KEY_ERROR = 11000
+
 
 class MongoDatabase:
     def __init__(self):
@@ -14,8 +18,168 @@ class MongoDatabase:
         login = os.getenv("DB_LOGIN")
         passw = os.getenv("DB_PASSWRD")
         uri = f"mongodb://{login}:{passw}@{host}:{port}/"
+        # pymongo импортируется при первом подключении: запуску без новых писем MongoDB не нужна
+        from pymongo import MongoClient
         self.connect = MongoClient(uri)[db_name]
+        self.bulk_batch_size = conf.data["database"].get("bulk_batch_size", 100)
+        self.log = Config.get_common_logger()
+        self._create_indexes()
 
     def table(self, table_name):
         return self.connect[table_name]
 
+    def _create_indexes(self):
+        from pymongo.errors import OperationFailure
+        try:
+            self.table("mails").create_index("id", unique=True, name="mails_id_unique")
+        except OperationFailure as e:
+            self.log.error("Не удалось создать уникальный индекс mails.id, возможно в коллекции есть дубли", exc_info=e)
+
+    def get_existing_mail_ids(self, mail_ids: Iterable[str]) -> Set[str]:
+        mail_ids = list(mail_ids)
+        if not mail_ids:
+            return set()
+        cursor = self.table("mails").find({"id": {"$in": mail_ids}}, projection={"id": 1, "_id": 0})
+        return {doc["id"] for doc in cursor}
+
+    def save_mails(self, mails: List[dict]) -> Tuple[List[str], List[str], Dict[str, Exception]]:
+        # Возвращает id записанных писем, id писем, которые уже были в БД, и ошибки писем, которые MongoDB
+        # не приняла (больше 16 МБ, не кодируется в BSON). Ошибки соединения и сервера пробрасываются
+        from bson.errors import InvalidDocument
+        from pymongo.errors import DocumentTooLarge
+        inserted, already_stored, rejected = [], [], {}
+        for start in range(0, len(mails), self.bulk_batch_size):
+            batch = mails[start:start + self.bulk_batch_size]
+            try:
+                upserted, errors = self._upsert_mails(batch)
+            except (InvalidDocument, DocumentTooLarge):
+                # Такие документы отклоняет сам драйвер до отправки, без номера письма: пачка пишется по одному
+                upserted, errors = set(), {}
+                for index, mail in enumerate(batch):
+                    try:
+                        mail_upserted, mail_errors = self._upsert_mails([mail])
+                    except (InvalidDocument, DocumentTooLarge) as e:
+                        mail_upserted, mail_errors = set(), {0: e}
+                    if mail_upserted:
+                        upserted.add(index)
+                    if mail_errors:
+                        errors[index] = mail_errors[0]
+
+            for index, mail in enumerate(batch):
+                if index in errors:
+                    rejected[mail["id"]] = errors[index]
+                else:
+                    (inserted if index in upserted else already_stored).append(mail["id"])
+        return inserted, already_stored, rejected
+
+    def _upsert_mails(self, batch: List[dict]) -> Tuple[Set[int], Dict[int, Exception]]:
+        # Номера записанных писем пачки и ошибки отдельных писем по номерам
+        from pymongo import UpdateOne
+        from pymongo.errors import BulkWriteError, WriteError
+        requests = [UpdateOne({"id": mail["id"]}, {"$setOnInsert": mail}, upsert=True) for mail in batch]
+        try:
+            return set(self.table("mails").bulk_write(requests, ordered=False).upserted_ids), {}
+        except BulkWriteError as e:
+            if e.details.get("writeConcernErrors"):
+                raise
+            # Дубликат при гонке двух upsert'ов - письмо уже сохранено
+            errors = {error["index"]: WriteError(error["errmsg"], error["code"], error)
+                      for error in e.details.get("writeErrors", []) if error["code"] != DUPLICATE_KEY_ERROR}
+            return {item["index"] for item in e.details.get("upserted", [])}, errors
+
+    def get_max_mail_uid(self, id_prefix: str) -> Optional[int]:
+        # Наибольший UID среди писем с id вида <id_prefix><uid>. UID в id - строка, поэтому максимум считается здесь
+        cursor = self.table("mails").find({"id": {"$regex": f"^{re.escape(id_prefix)}"}}, projection={"id": 1, "_id": 0})
+        uids = [doc["id"][len(id_prefix):] for doc in cursor]
+        return max((int(uid) for uid in uids if uid.isdigit()), default=None)
+
+    def get_offset(self, profile_key: str) -> Optional[dict]:
+        return self.table("offset_folder").find_one({"_id": profile_key})
+
+    def commit_offset(self, profile_key: str, folder: str, uid: int, uidvalidity: int) -> dict:
+        # Один документ на профиль, обновляется атомарно - нет момента, когда оффсетов ноль или два
+        from pymongo import ReturnDocument
+        return self.table("offset_folder").find_one_and_update(
+                {"_id": profile_key},
+                {"$set": {"profile": profile_key,
+                          "folder": folder,
+                          "uid": uid,
+                          "uidvalidity": uidvalidity,
+                          "updated_at": datetime.datetime.now()}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+        )
+
+    def get_legacy_offset(self, folder: str) -> Optional[dict]:
+        # Оффсеты старых версий были привязаны только к папке
+        return self.table("offset_folder").find_one({"folder": folder, "profile": {"$exists": False}})
+
+    def delete_legacy_offsets(self, folder: str):
+        self.table("offset_folder").delete_many({"folder": folder, "profile": {"$exists": False}})
+
+    def get_backfill_checkpoint(self, shard_id: str) -> Optional[dict]:
+        return self.table("backfill_checkpoints").find_one({"_id": shard_id})
+
+    def commit_backfill_checkpoint(self, shard_id: str, profile_key: str, folder: str, first_uid: int, last_uid: int,
+                                   uid: int, uidvalidity: int) -> dict:
+        # Отдельно от offset_folder: историческая выгрузка не сдвигает оффсет профиля
+        from pymongo import ReturnDocument
+        return self.table("backfill_checkpoints").find_one_and_update(
+                {"_id": shard_id},
+                {"$set": {"profile": profile_key,
+                          "folder": folder,
+                          "first_uid": first_uid,
+                          "last_uid": last_uid,
+                          "uid": uid,
+                          "uidvalidity": uidvalidity,
+                          "done": uid >= last_uid,
+                          "updated_at": datetime.datetime.now()}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+        )
+
+    def acquire_lease(self, key: str, owner: str, ttl_sec: float) -> Optional[dict]:
+        # Документ подходит, если аренда своя или истекла. Иначе upsert пытается вставить второй документ
+        # с тем же _id и получает DuplicateKeyError - аренду держит другой узел
+        from pymongo import ReturnDocument
+        from pymongo.errors import DuplicateKeyError
+        now = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            return self.table("leases").find_one_and_update(
+                    {"_id": key, "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+                    {"$set": {"owner": owner,
+                              "expires_at": now + datetime.timedelta(seconds=ttl_sec),
+                              "renewed_at": now}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            return None
+
+    def renew_lease(self, key: str, owner: str, ttl_sec: float) -> bool:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        result = self.table("leases").update_one(
+                {"_id": key, "owner": owner},
+                {"$set": {"expires_at": now + datetime.timedelta(seconds=ttl_sec), "renewed_at": now}},
+        )
+        return result.matched_count == 1
+
+    def release_lease(self, key: str, owner: str):
+        self.table("leases").delete_one({"_id": key, "owner": owner})
+
+    def count_leases(self, prefix: str) -> int:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return self.table("leases").count_documents({"_id": {"$regex": f"^{re.escape(prefix)}"},
+                                                     "expires_at": {"$gte": now}})
+
+    def record_failed_mail(self, profile_key: str, mail_id: str, uid: int, error: Exception):
+        self.table("failed_mails").update_one(
+                {"_id": mail_id},
+                {"$set": {"profile": profile_key,
+                          "uid": uid,
+                          "error": repr(error),
+                          "traceback": "".join(traceback.format_exception(type(error), error, error.__traceback__)),
+                          "failed_at": datetime.datetime.now()},
+                 "$inc": {"attempts": 1}},
+                upsert=True,
+        )
@@ -0,0 +1,114 @@
+import asyncio
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from common.config_controller import Config
+from database.database import MongoDatabase
+from .connection_pool import ImapConnectionPool
+from .lease import LeaseManager
+from .mail_logic import MailFacade
+from .profile import ConfigProfile
+from .render import RenderPool
+
+
+class AsyncEngine:
+    # Все профили в одном процессе, цикл событий только планирует проходы по папкам и интервалы опроса.
+    # Запросы к IMAP и MongoDB блокирующие: проход - тот же MailFacade.process_new_mail в потоке пула.
+    # max_concurrency ограничивает число папок, обрабатываемых одновременно, max_connections - сессии на ящик.
+    # У каждого этапа конвейера папки один поток, поэтому потоков не больше max_concurrency * (этапов + 1)
+    STAGE_WORKERS = 1
+
+    def __init__(self, profiles: List[ConfigProfile], run_once: bool = True, max_concurrency: int = None):
+        engine_conf = Config().data.get("engine") or {}
+        self.profiles = profiles
+        self.run_once = run_once
+        self.max_concurrency = max_concurrency or engine_conf.get("max_concurrency", 8)
+        self.stop_event = threading.Event()
+        self.db_conn: Optional[MongoDatabase] = None
+        self.render_pool: Optional[RenderPool] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.leases: Optional[LeaseManager] = None
+        self.log = Config.get_common_logger()
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        self._install_signal_handlers()
+        self.db_conn = MongoDatabase()
+        self.leases = LeaseManager.from_config(self.db_conn)
+        self.render_pool = RenderPool.from_config(Config().attachment_path)
+        # Один поток на папку в работе, больше одновременных проходов семафор не пропустит
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="engine")
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        pools: List[ImapConnectionPool] = []
+        tasks = []
+        for group in ImapConnectionPool.group_profiles(self.profiles).values():
+            pool = ImapConnectionPool.for_profiles(group)
+            pools.append(pool)
+            # Свой семафор ящика, чтобы borrow() в пуле потоков никогда не ждал свободную сессию
+            account_semaphore = asyncio.Semaphore(pool.max_size)
+            for profile in group:
+                tasks.append(self._run_profile(profile, pool, semaphore, account_semaphore))
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for pool in pools:
+                pool.close()
+            self.render_pool.shutdown()
+            self.executor.shutdown(wait=True)
+            if self.leases is not None:
+                self.leases.close()
+
+    def _install_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(signum, self._on_signal, signum)
+            except (NotImplementedError, RuntimeError):
+                # Windows: обработчики сигналов в цикле событий не поддерживаются
+                pass
+
+    def _on_signal(self, signum):
+        self.log.info(f"Получен сигнал {signum}, завершаем работу после записи текущих пачек")
+        self.stop_event.set()
+
+    async def _run_profile(self, profile: ConfigProfile, connection_pool: ImapConnectionPool,
+                           semaphore: asyncio.Semaphore, account_semaphore: asyncio.Semaphore):
+        backoff = 0
+        while not self.stop_event.is_set():
+            try:
+                async with account_semaphore, semaphore:
+                    await self._process_profile(profile, connection_pool)
+                backoff = 0
+                delay = profile.poll_interval_sec
+            except Exception as e:
+                backoff = min(backoff * 2 or profile.min_backoff_sec, profile.max_backoff_sec)
+                delay = backoff
+                self.log.error(f"Ошибка обработки папки {profile.folder}, повтор через {backoff} сек", exc_info=e)
+
+            if self.run_once:
+                break
+            await self._sleep(delay)
+        self.log.info(f"Обработка папки {profile.folder} завершена")
+
+    async def _process_profile(self, profile: ConfigProfile, connection_pool: ImapConnectionPool):
+        loop = asyncio.get_running_loop()
+        facade = MailFacade(profile, db_conn=self.db_conn, render_pool=self.render_pool, stop_event=self.stop_event,
+                            connection_pool=connection_pool, leases=self.leases, stage_workers=self.STAGE_WORKERS)
+        try:
+            await loop.run_in_executor(self.executor, facade.process_new_mail)
+        finally:
+            # Аренда берется на один проход: между проходами папку может забрать другой узел
+            await loop.run_in_executor(self.executor, facade.close)
+
+    async def _sleep(self, delay: float):
+        # Короткие шаги, чтобы сигнал остановки не ждал окончания интервала опроса
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + delay
+        while not self.stop_event.is_set() and loop.time() < deadline:
+            await asyncio.sleep(min(1, deadline - loop.time()))
@@ -0,0 +1,185 @@
+import binascii
+import hashlib
+import os
+import re
+import uuid
+from email.message import Message
+from typing import Iterable, Optional
+
+# Сколько символов закодированного содержимого вложения декодируется за раз
+CHUNK_SIZE = 1024 * 1024
+
+_UNSAFE_EXT_CHARS_RE = re.compile(r"[^a-z0-9]")
+_WHITESPACE = b" \t\r\n"
+
+
+class AttachmentStoreError(Exception):
+    # Ошибка записи вложения в хранилище (диск), в отличие от ошибок получения содержимого
+    pass
+
+
+def _encode_chunk(chunk: str) -> bytes:
+    # Так же email.message.Message.get_payload получает байты из строки содержимого
+    try:
+        return chunk.encode("ascii", "surrogateescape")
+    except UnicodeEncodeError:
+        return chunk.encode("raw-unicode-escape")
+
+
+def get_attachment_filename(part: Message) -> Optional[str]:
+    # Имя файла, если часть сохраняется как вложение, иначе None
+    if part.get_content_maintype() == 'multipart' or part.get('Content-Disposition') is None:
+        return None
+    filename = part.get_filename()
+    if filename is None or filename.find('=?utf-8?') != -1:
+        return None
+    return filename
+
+
+class _Base64Decoder:
+    def __init__(self):
+        self._rest = b""
+
+    def decode(self, chunk: bytes) -> bytes:
+        data = self._rest + chunk.translate(None, _WHITESPACE)
+        size = len(data) - len(data) % 4
+        self._rest = data[size:]
+        return binascii.a2b_base64(data[:size]) if size else b""
+
+    def flush(self) -> bytes:
+        rest, self._rest = self._rest, b""
+        if not rest:
+            return b""
+        try:
+            return binascii.a2b_base64(rest + b"=" * (-len(rest) % 4))
+        except binascii.Error:
+            return b""
+
+
+class _QuotedPrintableDecoder:
+    def __init__(self):
+        self._rest = b""
+
+    def decode(self, chunk: bytes) -> bytes:
+        data = self._rest + chunk
+        end = data.rfind(b"\n") + 1
+        self._rest = data[end:]
+        return binascii.a2b_qp(data[:end]) if end else b""
+
+    def flush(self) -> bytes:
+        rest, self._rest = self._rest, b""
+        return binascii.a2b_qp(rest) if rest else b""
+
+
+class _IdentityDecoder:
+    def decode(self, chunk: bytes) -> bytes:
+        return chunk
+
+    def flush(self) -> bytes:
+        return b""
+
+
+_DECODERS = {
+    "base64": _Base64Decoder,
+    "quoted-printable": _QuotedPrintableDecoder,
+    "7bit": _IdentityDecoder,
+    "8bit": _IdentityDecoder,
+    "binary": _IdentityDecoder,
+}
+
+
+def is_streamable(encoding: Optional[str]) -> bool:
+    return (encoding or "7bit").strip().lower() in _DECODERS
+
+
+class BlobWriter:
+    # Потоково декодирует вложение во временный файл, считая хэш содержимого
+    def __init__(self, store: "AttachmentStore", filename: str, content_type: str, encoding: Optional[str]):
+        self.store = store
+        self.filename = filename
+        self.content_type = content_type
+        self._decoder = _DECODERS.get((encoding or "7bit").strip().lower(), _IdentityDecoder)()
+        self._hash = hashlib.sha256()
+        self._size = 0
+        self._tmp_path = os.path.join(store.tmp_path, uuid.uuid4().hex)
+        self._file = open(self._tmp_path, "wb")
+
+    def write(self, encoded_chunk: bytes):
+        self._write_decoded(self._decoder.decode(encoded_chunk))
+
+    def _write_decoded(self, data: bytes):
+        if data:
+            self._hash.update(data)
+            self._size += len(data)
+            self._file.write(data)
+
+    def commit(self) -> dict:
+        self._write_decoded(self._decoder.flush())
+        self._file.close()
+        digest = self._hash.hexdigest()
+        path = self.store.get_blob_path(digest, self.filename)
+        if os.path.exists(path):
+            # Такое вложение уже сохранено
+            os.remove(self._tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self._tmp_path, path)
+        return {"sha256": digest,
+                "path": path,
+                "filename": self.filename,
+                "size": self._size,
+                "content_type": self.content_type}
+
+    def abort(self):
+        try:
+            self._file.close()
+            if os.path.exists(self._tmp_path):
+                os.remove(self._tmp_path)
+        except OSError:
+            pass
+
+
+class AttachmentStore:
+    # Вложения хранятся по хэшу содержимого в папках по префиксу хэша: <path>/ab/cd/abcd...<ext>.
+    # Одинаковые вложения из разных писем сохраняются один раз
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = os.path.join(path, ".tmp")
+        os.makedirs(self.tmp_path, exist_ok=True)
+
+    def get_blob_path(self, digest: str, filename: str) -> str:
+        ext = _UNSAFE_EXT_CHARS_RE.sub("", os.path.splitext(filename)[1].lower())[:16]
+        return os.path.join(self.path, digest[:2], digest[2:4], f"{digest}.{ext}" if ext else digest)
+
+    def open_writer(self, filename: str, content_type: str, encoding: Optional[str]) -> BlobWriter:
+        return BlobWriter(self, filename, content_type, encoding)
+
+    def save_part(self, part: Message, filename: str) -> dict:
+        encoding = (part.get("Content-Transfer-Encoding") or "7bit").strip().lower()
+        payload = part.get_payload()
+        if encoding not in _DECODERS or not isinstance(payload, str):
+            # Редкие кодировки (uuencode) декодирует сам email
+            return self.save_chunks([part.get_payload(decode=True) or b""], filename, part.get_content_type(), "binary")
+        chunks = (_encode_chunk(payload[start:start + CHUNK_SIZE]) for start in range(0, len(payload), CHUNK_SIZE))
+        return self.save_chunks(chunks, filename, part.get_content_type(), encoding)
+
+    def save_chunks(self, chunks: Iterable[bytes], filename: str, content_type: str, encoding: Optional[str]) -> dict:
+        # Закодированное содержимое вложения по частям, например прямо из ответов IMAP сервера.
+        # Ошибки записи - AttachmentStoreError, ошибки итератора chunks (например, сети) передаются как есть
+        try:
+            writer = self.open_writer(filename, content_type, encoding)
+        except Exception as e:
+            raise AttachmentStoreError(f"Не удалось создать файл вложения {filename}") from e
+        try:
+            for chunk in chunks:
+                try:
+                    writer.write(chunk)
+                except Exception as e:
+                    raise AttachmentStoreError(f"Не удалось записать вложение {filename}") from e
+            try:
+                return writer.commit()
+            except Exception as e:
+                raise AttachmentStoreError(f"Не удалось записать вложение {filename}") from e
+        except BaseException:
+            writer.abort()
+            raise
@@ -0,0 +1,103 @@
+import datetime
+import multiprocessing
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from common.config_controller import Config
+from database.database import MongoDatabase
+from .checkpoint import ShardCheckpoint
+from .lease import LeaseManager
+from .mail_logic import EmailConnection, MailFacade
+from .profile import ConfigProfile
+
+_worker_db: Optional[MongoDatabase] = None
+_worker_leases: Optional[LeaseManager] = None
+
+
+@dataclass
+class Shard:
+    first_uid: int
+    last_uid: int
+    messages: int
+
+
+def split_shards(uids: List[int], shard_size: int) -> List[Shard]:
+    # Шарды по количеству писем, а не по ширине диапазона UID: после удалений UID идут с большими пропусками
+    return [Shard(chunk[0], chunk[-1], len(chunk))
+            for chunk in (uids[start:start + shard_size] for start in range(0, len(uids), shard_size))]
+
+
+def _init_worker():
+    # Одно подключение к MongoDB на процесс, а не на шард
+    global _worker_db, _worker_leases
+    _worker_db = MongoDatabase()
+    # Несколько узлов с одной и той же командой делят шарды через аренды
+    _worker_leases = LeaseManager.from_config(_worker_db)
+
+
+def _run_shard(profile: ConfigProfile, shard: Shard, uidvalidity: int) -> Optional[str]:
+    checkpoint = ShardCheckpoint(_worker_db, profile, shard.first_uid, shard.last_uid, uidvalidity)
+    facade = MailFacade(profile, db_conn=_worker_db, checkpoint=checkpoint, leases=_worker_leases)
+    try:
+        if not facade.process_new_mail():
+            Config.get_common_logger().info(f"Шард {checkpoint.shard_id} выгружает другой узел")
+    except Exception as e:
+        Config.get_common_logger().error(f"Ошибка обработки шарда {checkpoint.shard_id}", exc_info=e)
+        return repr(e)
+    finally:
+        facade.close()
+    return None
+
+
+class Backfill:
+    # Историческая выгрузка папки за период или диапазон UID. Диапазон делится на шарды, шарды обрабатываются
+    # в отдельных процессах, у каждого свой чекпоинт в backfill_checkpoints. Оффсет профиля не меняется,
+    # а письма, уже выгруженные обычным режимом, отсекаются по id - backfill можно запускать рядом с daemon
+    def __init__(self, profile: ConfigProfile, since: datetime.date = None, before: datetime.date = None,
+                 uid_from: int = None, uid_to: int = None, shard_size: int = None, workers: int = None):
+        conf = Config().data.get("backfill") or {}
+        self.profile = profile
+        self.since = since
+        self.before = before
+        self.uid_from = uid_from
+        self.uid_to = uid_to
+        self.shard_size = shard_size or conf.get("shard_size", 5000)
+        # Каждый процесс держит свое IMAP-соединение, а почтовые серверы ограничивают их число
+        self.workers = workers or conf.get("workers", 4)
+        self.log = Config.get_common_logger()
+
+    def plan(self, db_conn: MongoDatabase) -> Tuple[int, List[Shard]]:
+        email_connect = EmailConnection(self.profile.imap_host, self.profile.login, self.profile.passw,
+                                        port=self.profile.imap_port, use_ssl=self.profile.use_ssl)
+        try:
+            uidvalidity, _ = email_connect.select_folder(self.profile.folder)
+            uids = email_connect.search_uids(self.profile.folder, since=self.since, before=self.before)
+        finally:
+            email_connect.logout()
+
+        uids = [uid for uid in uids
+                if (self.uid_from is None or uid >= self.uid_from) and (self.uid_to is None or uid <= self.uid_to)]
+        shards = split_shards(uids, self.shard_size)
+        pending = [shard for shard in shards
+                   if not ShardCheckpoint(db_conn, self.profile, shard.first_uid, shard.last_uid,
+                                          uidvalidity).is_done()]
+        self.log.info(f"Историческая выгрузка папки {self.profile.folder}: {len(uids)} писем, {len(shards)} шардов, "
+                      f"из них уже выгружено {len(shards) - len(pending)}")
+        return uidvalidity, pending
+
+    def run(self) -> int:
+        # Возвращает количество шардов, завершившихся с ошибкой; их можно дозапустить той же командой
+        uidvalidity, shards = self.plan(MongoDatabase())
+        if not shards:
+            return 0
+
+        failed = 0
+        with multiprocessing.Pool(min(self.workers, len(shards)), initializer=_init_worker) as pool:
+            errors = pool.starmap(_run_shard, [(self.profile, shard, uidvalidity) for shard in shards])
+            for shard, error in zip(shards, errors):
+                if error is not None:
+                    failed += 1
+                    self.log.error(f"Шард {shard.first_uid}-{shard.last_uid} папки {self.profile.folder} "
+                                   f"не выгружен: {error}")
+        self.log.info(f"Историческая выгрузка папки {self.profile.folder} завершена, шардов с ошибкой: {failed}")
+        return failed
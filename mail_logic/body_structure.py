@@ -0,0 +1,129 @@
+from email.message import Message
+from typing import Dict, Iterator, List, Optional
+
+
+def _to_str(value) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return str(value)
+
+
+def _to_params(values) -> Dict[str, str]:
+    if not isinstance(values, list):
+        return {}
+    return {_to_str(values[i]).lower(): _to_str(values[i + 1]) for i in range(0, len(values) - 1, 2)}
+
+
+class BodyPart:
+    # Описание MIME-части письма из ответа BODYSTRUCTURE, без содержимого
+    def __init__(self, section: str, maintype: str, subtype: str, params: Dict[str, str] = None,
+                 encoding: Optional[str] = None, size: int = 0, disposition: Optional[str] = None,
+                 disposition_params: Dict[str, str] = None, children: List["BodyPart"] = None):
+        self.section = section
+        self.maintype = maintype
+        self.subtype = subtype
+        self.params = params or {}
+        self.encoding = encoding
+        self.size = size
+        self.disposition = disposition
+        self.disposition_params = disposition_params or {}
+        self.children = children or []
+
+    @property
+    def is_multipart(self) -> bool:
+        return self.maintype == "multipart"
+
+    @property
+    def filename(self) -> Optional[str]:
+        return self.disposition_params.get("filename") or self.params.get("name")
+
+    @classmethod
+    def parse(cls, structure: list, section: str = "") -> "BodyPart":
+        if isinstance(structure[0], list):
+            children = []
+            pos = 0
+            while pos < len(structure) and isinstance(structure[pos], list):
+                child_section = f"{section}.{pos + 1}" if section else str(pos + 1)
+                children.append(cls.parse(structure[pos], child_section))
+                pos += 1
+            subtype = _to_str(structure[pos]).lower() if pos < len(structure) else "mixed"
+            return cls(section=section, maintype="multipart", subtype=subtype, children=children)
+
+        maintype = _to_str(structure[0]).lower()
+        subtype = _to_str(structure[1]).lower()
+        # Для верхнеуровневого не multipart письма тело доступно как BODY[1]
+        section = section or "1"
+        if maintype == "text":
+            extension = 8
+        elif maintype == "message" and subtype == "rfc822":
+            extension = 10
+        else:
+            extension = 7
+
+        disposition = None
+        disposition_params = {}
+        if len(structure) > extension + 1 and isinstance(structure[extension + 1], list):
+            disposition = _to_str(structure[extension + 1][0])
+            if len(structure[extension + 1]) > 1:
+                disposition_params = _to_params(structure[extension + 1][1])
+
+        return cls(section=section,
+                   maintype=maintype,
+                   subtype=subtype,
+                   params=_to_params(structure[2]),
+                   encoding=_to_str(structure[5]),
+                   size=int(structure[6] or 0),
+                   disposition=disposition,
+                   disposition_params=disposition_params)
+
+    def walk(self) -> Iterator["BodyPart"]:
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    # Выбор частей повторяет MailBuilder._get_mail_body_part_like_plaint_text/_get_mail_body_part_like_html
+    def find_plain_text_part(self) -> "BodyPart":
+        part = self
+        while part.is_multipart:
+            part = part.children[0]
+        return part
+
+    def find_html_part(self) -> "BodyPart":
+        part = self
+        try:
+            while part.is_multipart:
+                part = part.children[1]
+            return part
+        except IndexError:
+            return part.find_plain_text_part()
+
+    # Повторяет условия MailBuilder.save_attachment
+    def attachment_parts(self) -> List["BodyPart"]:
+        return [part for part in self.walk()
+                if not part.is_multipart and part.disposition is not None
+                and part.filename is not None and part.filename.find('=?utf-8?') == -1]
+
+    def find_body_part(self, force_to_image: bool) -> "BodyPart":
+        return self.find_html_part() if force_to_image else self.find_plain_text_part()
+
+    def to_message(self, payloads: Dict[str, bytes], root: Message = None) -> Message:
+        # Собирает email.message.Message той же структуры, что и исходное письмо,
+        # но с содержимым только у скачанных частей
+        message = root if root is not None else Message()
+        if self.is_multipart:
+            message["Content-Type"] = f"multipart/{self.subtype}"
+            message.set_payload([])
+            for child in self.children:
+                message.attach(child.to_message(payloads))
+            return message
+
+        message.add_header("Content-Type", f"{self.maintype}/{self.subtype}", **self.params)
+        if self.encoding:
+            message["Content-Transfer-Encoding"] = self.encoding
+        if self.disposition is not None:
+            message.add_header("Content-Disposition", self.disposition, **self.disposition_params)
+        # Так же хранит содержимое email.parser.BytesParser
+        message.set_payload(payloads.get(self.section, b"").decode("ascii", errors="surrogateescape"))
+        return message
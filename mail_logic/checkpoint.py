@@ -0,0 +1,112 @@
+from typing import Tuple, TYPE_CHECKING
+
+from common.config_controller import Config
+from database.database import MongoDatabase
+from .profile import ConfigProfile
+
+if TYPE_CHECKING:
+    from .mail_logic import EmailConnection
+
+
+class OffsetCheckpoint:
+    # Оффсет инкрементальной выгрузки профиля (коллекция offset_folder): UID последнего обработанного письма
+    def __init__(self, db_conn: MongoDatabase, profile: ConfigProfile):
+        self.db_conn = db_conn
+        self.profile = profile
+        self.folder = profile.folder
+        # Ключ аренды в коллекции leases, если запущено несколько экземпляров
+        self.lease_key = f"profile:{profile.key}"
+        self.log = Config.get_common_logger()
+
+    def get_range(self, email_connect: "EmailConnection", uidvalidity: int, last_uid: int) -> Tuple[int, int]:
+        # Возвращает (последний обработанный UID, последний UID для обработки)
+        return self._get_offset_uid(email_connect, uidvalidity, last_uid), last_uid
+
+    def save(self, uid: int, uidvalidity: int):
+        self.db_conn.commit_offset(self.profile.key, self.folder, uid, uidvalidity)
+        self.log.info(f"Оффсет папки {self.folder} обновлен до uid {uid}")
+
+    def _get_offset_uid(self, email_connect: "EmailConnection", uidvalidity: int, last_uid: int) -> int:
+        # Оффсет хранится как UID + UIDVALIDITY: номер письма из SELECT сдвигается при удалении писем
+        offset_data = self.db_conn.get_offset(self.profile.key)
+        if offset_data is None:
+            return self._migrate_legacy_offset(email_connect, uidvalidity, last_uid)
+
+        if int(offset_data["uidvalidity"]) != uidvalidity:
+            self.log.warning(f'Сменился UIDVALIDITY папки {self.folder}: {offset_data["uidvalidity"]} -> '
+                             f'{uidvalidity}. Оффсет сброшен на последнее письмо')
+            self.db_conn.commit_offset(self.profile.key, self.folder, last_uid, uidvalidity)
+            return last_uid
+
+        return int(offset_data["uid"])
+
+    def _migrate_legacy_offset(self, email_connect: "EmailConnection", uidvalidity: int, last_uid: int) -> int:
+        legacy_offset = self.db_conn.get_legacy_offset(self.folder)
+        if legacy_offset is None:
+            offset_uid = last_uid
+            self.log.info(f'Инициирован оффсет для папки {self.folder}')
+        elif "uidvalidity" in legacy_offset and int(legacy_offset["uidvalidity"]) == uidvalidity:
+            offset_uid = int(legacy_offset["uid"])
+        elif "offset" in legacy_offset:
+            offset_uid = self._convert_legacy_offset(email_connect, uidvalidity, last_uid, int(legacy_offset["offset"]))
+        else:
+            offset_uid = last_uid
+
+        self.db_conn.commit_offset(self.profile.key, self.folder, offset_uid, uidvalidity)
+        if legacy_offset is not None:
+            self.db_conn.delete_legacy_offsets(self.folder)
+        return offset_uid
+
+    def _convert_legacy_offset(self, email_connect: "EmailConnection", uidvalidity: int, last_uid: int,
+                               offset: int) -> int:
+        # Старый формат оффсета - номер письма (EXISTS прошлого запуска), переводим его в UID.
+        # После удаления писем номер может оказаться больше числа писем в папке
+        seq = min(offset, email_connect.exists_count)
+        if seq <= 0:
+            return 0
+        try:
+            offset_uid = email_connect.get_uid_by_seq(seq, self.folder)
+        except Exception as e:
+            stored_uid = self.db_conn.get_max_mail_uid(self.profile.get_mail_id_prefix(uidvalidity))
+            offset_uid = stored_uid if stored_uid is not None else last_uid
+            self.log.warning(f"Не удалось перевести оффсет {offset} папки {self.folder} в uid, оффсет взят по "
+                             f"{'последнему сохраненному письму' if stored_uid is not None else 'последнему письму'}: "
+                             f"uid {offset_uid}", exc_info=e)
+            return offset_uid
+        self.log.info(f"Оффсет {offset} папки {self.folder} переведен в uid {offset_uid}")
+        return offset_uid
+
+
+class ShardCheckpoint:
+    # Прогресс одного шарда исторической выгрузки (коллекция backfill_checkpoints).
+    # Оффсет профиля не трогает, поэтому выгрузка истории идет параллельно с обычной
+    def __init__(self, db_conn: MongoDatabase, profile: ConfigProfile, first_uid: int, last_uid: int,
+                 uidvalidity: int):
+        self.db_conn = db_conn
+        self.profile = profile
+        self.first_uid = first_uid
+        self.last_uid = last_uid
+        self.uidvalidity = uidvalidity
+        self.shard_id = f"{profile.key}#{first_uid}-{last_uid}"
+        self.lease_key = f"backfill:{self.shard_id}"
+        self.log = Config.get_common_logger()
+
+    def get_range(self, email_connect: "EmailConnection", uidvalidity: int, last_uid: int) -> Tuple[int, int]:
+        if uidvalidity != self.uidvalidity:
+            raise Exception(f"Сменился UIDVALIDITY папки {self.profile.folder}: {self.uidvalidity} -> {uidvalidity}. "
+                            f"Историческую выгрузку нужно запустить заново")
+        checkpoint = self.db_conn.get_backfill_checkpoint(self.shard_id)
+        done_uid = self.first_uid - 1
+        if checkpoint is not None and int(checkpoint["uidvalidity"]) == uidvalidity:
+            done_uid = int(checkpoint["uid"])
+        return done_uid, min(self.last_uid, last_uid)
+
+    def is_done(self) -> bool:
+        checkpoint = self.db_conn.get_backfill_checkpoint(self.shard_id)
+        return (checkpoint is not None and int(checkpoint["uidvalidity"]) == self.uidvalidity
+                and int(checkpoint["uid"]) >= self.last_uid)
+
+    def save(self, uid: int, uidvalidity: int):
+        self.db_conn.commit_backfill_checkpoint(self.shard_id, self.profile.key, self.profile.folder,
+                                                self.first_uid, self.last_uid, uid, uidvalidity)
+        self.log.info(f"Шард {self.shard_id} обработан до uid {uid}")
@@ -0,0 +1,81 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+from common.config_controller import Config
+from .mail_logic import EmailConnection
+from .profile import ConfigProfile
+
+
+class ImapConnectionPool:
+    # Общие IMAP-сессии одного ящика: профили этого ящика по очереди делают SELECT своих папок.
+    # Количество одновременных логинов ограничено max_size
+    def __init__(self, imap_host: str, login: str, passw: str, max_size: int = 2, port: int = 993,
+                 use_ssl: bool = True):
+        self.imap_host = imap_host
+        self.login = login
+        self.passw = passw
+        self.max_size = max_size
+        self.port = port
+        self.use_ssl = use_ssl
+        self._idle_connections: List[EmailConnection] = []
+        self._semaphore = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self.log = Config.get_common_logger()
+
+    @classmethod
+    def group_profiles(cls, profiles: List[ConfigProfile]) -> Dict[Tuple[str, str], List[ConfigProfile]]:
+        groups = OrderedDict()
+        for profile in profiles:
+            groups.setdefault((profile.imap_host, profile.login), []).append(profile)
+        return groups
+
+    @classmethod
+    def for_profiles(cls, profiles: List[ConfigProfile]) -> "ImapConnectionPool":
+        first = profiles[0]
+        return cls(first.imap_host, first.login, first.passw,
+                   max_size=max(profile.max_connections for profile in profiles),
+                   port=first.imap_port, use_ssl=first.use_ssl)
+
+    def borrow(self) -> EmailConnection:
+        self._semaphore.acquire()
+        with self._lock:
+            if self._idle_connections:
+                return self._idle_connections.pop()
+        try:
+            return EmailConnection(self.imap_host, self.login, self.passw, port=self.port, use_ssl=self.use_ssl)
+        except Exception:
+            self._semaphore.release()
+            raise
+
+    def release(self, connection: EmailConnection, broken: bool = False):
+        if broken:
+            self._logout(connection)
+        else:
+            with self._lock:
+                self._idle_connections.append(connection)
+        self._semaphore.release()
+
+    @contextmanager
+    def connection(self) -> Iterator[EmailConnection]:
+        connection = self.borrow()
+        try:
+            yield connection
+        except Exception:
+            # После ошибки состояние сессии неизвестно, такое соединение больше не используем
+            self.release(connection, broken=True)
+            raise
+        self.release(connection)
+
+    def _logout(self, connection: EmailConnection):
+        try:
+            connection.logout()
+        except Exception as e:
+            self.log.debug(f"Ошибка при закрытии соединения с {self.imap_host}", exc_info=e)
+
+    def close(self):
+        with self._lock:
+            connections, self._idle_connections = self._idle_connections, []
+        for connection in connections:
+            self._logout(connection)
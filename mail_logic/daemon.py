@@ -0,0 +1,111 @@
+import signal
+import threading
+from typing import List, Optional
+
+from common.config_controller import Config
+from database.database import MongoDatabase
+from .connection_pool import ImapConnectionPool
+from .lease import LeaseLost, LeaseManager
+from .mail_logic import MailFacade
+from .profile import ConfigProfile
+from .render import RenderPool
+
+
+class ProfileWorker(threading.Thread):
+    # Держит соединение с почтой открытым и обрабатывает папку по мере прихода писем
+    def __init__(self, profile: ConfigProfile, db_conn: MongoDatabase, render_pool: RenderPool,
+                 stop_event: threading.Event, connection_pool: ImapConnectionPool, hold_connection: bool,
+                 leases: Optional[LeaseManager] = None):
+        super().__init__(name=f"profile-{profile.folder}")
+        self.profile = profile
+        self.db_conn = db_conn
+        self.render_pool = render_pool
+        self.stop_event = stop_event
+        self.connection_pool = connection_pool
+        # IDLE занимает сессию целиком, поэтому ее держат только профили, которым хватило соединений пула
+        self.hold_connection = hold_connection
+        self.use_idle = profile.use_idle and hold_connection
+        self.leases = leases
+        self.log = Config.get_common_logger()
+
+    def run(self):
+        facade = None
+        backoff = 0
+        while not self.stop_event.is_set():
+            try:
+                if facade is None:
+                    facade = MailFacade(self.profile, db_conn=self.db_conn, render_pool=self.render_pool,
+                                        stop_event=self.stop_event, connection_pool=self.connection_pool,
+                                        hold_connection=self.hold_connection, leases=self.leases)
+                if not facade.process_new_mail():
+                    # Папку обрабатывает другой узел: соединение не держим и ждем, пока его аренда истечет
+                    facade.close()
+                    facade = None
+                    self.stop_event.wait(self.leases.heartbeat_sec)
+                    continue
+                backoff = 0
+                facade.wait_for_new_mail(use_idle=self.use_idle)
+            except LeaseLost as e:
+                self.log.warning(f"Обработка папки {self.profile.folder} передана другому узлу: {e}")
+                facade.close()
+                facade = None
+            except Exception as e:
+                # Экспоненциальная задержка перед переподключением, чтобы не долбить упавший сервер
+                backoff = min(backoff * 2 or self.profile.min_backoff_sec, self.profile.max_backoff_sec)
+                self.log.error(f"Ошибка обработки папки {self.profile.folder}, повтор через {backoff} сек", exc_info=e)
+                if facade is not None:
+                    facade.close(broken=True)
+                    facade = None
+                self.stop_event.wait(backoff)
+
+        if facade is not None:
+            facade.close()
+        self.log.info(f"Обработка папки {self.profile.folder} остановлена")
+
+
+class Daemon:
+    def __init__(self, profiles: List[ConfigProfile], db_conn: MongoDatabase = None):
+        self.profiles = profiles
+        self.db_conn = db_conn
+        self.stop_event = threading.Event()
+        self.log = Config.get_common_logger()
+
+    def _on_signal(self, signum, frame):
+        self.log.info(f"Получен сигнал {signum}, завершаем работу после записи текущих пачек")
+        self.stop_event.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+
+        db_conn = self.db_conn or MongoDatabase()
+        leases = LeaseManager.from_config(db_conn)
+        if leases is not None:
+            leases.join(len(self.profiles))
+        render_pool = RenderPool.from_config(Config().attachment_path)
+        pools = []
+        workers = []
+        for group in ImapConnectionPool.group_profiles(self.profiles).values():
+            pool = ImapConnectionPool.for_profiles(group)
+            pools.append(pool)
+            # Одна сессия пула всегда остается для профилей, работающих опросом
+            idle_slots = pool.max_size if len(group) <= pool.max_size else pool.max_size - 1
+            for profile in group:
+                hold_connection = profile.use_idle and idle_slots > 0
+                if hold_connection:
+                    idle_slots -= 1
+                workers.append(ProfileWorker(profile, db_conn, render_pool, self.stop_event, pool, hold_connection,
+                                             leases))
+        for worker in workers:
+            worker.start()
+
+        # join с таймаутом, чтобы главный поток продолжал получать сигналы
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(timeout=1)
+
+        for pool in pools:
+            pool.close()
+        render_pool.shutdown()
+        if leases is not None:
+            leases.close()
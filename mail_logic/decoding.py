@@ -0,0 +1,61 @@
+import re
+import threading
+from typing import Dict, Optional, Tuple
+
+# chardet смотрит только начало содержимого
+DETECT_SAMPLE_SIZE = 32 * 1024
+DETECTED_CACHE_SIZE = 4096
+
+_UNICODE_ESCAPE_RE = re.compile(r"\\u([0-9a-fA-F]{4})")
+
+
+def unescape_unicode(text: str) -> str:
+    # В некоторых письмах символы приходят как литералы \uXXXX
+    if text.find("\\u") == -1:
+        return text
+    return _UNICODE_ESCAPE_RE.sub(lambda match: chr(int(match.group(1), 16)), text)
+
+
+class CharsetDecoder:
+    # Сначала кодировка из Content-Type, затем строгий utf-8, и только потом chardet
+    # по ограниченному куску с запоминанием результата для отправителя и заявленной кодировки
+    def __init__(self, sample_size: int = DETECT_SAMPLE_SIZE, cache_size: int = DETECTED_CACHE_SIZE):
+        self.sample_size = sample_size
+        self.cache_size = cache_size
+        self._detected: Dict[Tuple[str, Optional[str]], str] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _try_decode(content: bytes, encoding: Optional[str]) -> Optional[str]:
+        if not encoding:
+            return None
+        try:
+            return content.decode(encoding)
+        except (LookupError, UnicodeDecodeError):
+            return None
+
+    def decode(self, content: bytes, declared_charset: Optional[str] = None, sender: str = "") -> str:
+        text = self._try_decode(content, declared_charset)
+        if text is None:
+            text = self._try_decode(content, "utf-8")
+        if text is not None:
+            return text
+
+        cache_key = (sender, declared_charset)
+        with self._lock:
+            encoding = self._detected.get(cache_key)
+        text = self._try_decode(content, encoding)
+        if text is not None:
+            return text
+
+        # chardet нужен редко, импорт при первом письме без верной кодировки
+        import chardet
+        detected = chardet.detect(content[:self.sample_size])
+        encoding = detected["encoding"]
+        if detected["confidence"] < 0.5 or self._try_decode(b"", encoding) is None:
+            encoding = "utf-8"
+        with self._lock:
+            if len(self._detected) >= self.cache_size:
+                self._detected.clear()
+            self._detected[cache_key] = encoding
+        return content.decode(encoding, errors="replace")
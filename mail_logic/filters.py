@@ -0,0 +1,96 @@
+import itertools
+import re
+import threading
+from collections import Counter
+from typing import List, Optional, Pattern
+
+from common.metrics import Metrics
+
+# Шаблоны с обратными ссылками по номеру или флагами в начале нельзя объединить в одну альтернативу
+_NOT_MERGEABLE_RE = re.compile(r"\\[1-9]|\(\?P=|^\(\?[aiLmsux]+\)")
+
+
+def compile_regex(pattern: str, name: str, profile_name: str) -> Pattern:
+    try:
+        return re.compile(pattern)
+    except re.error as e:
+        raise Exception(f"Неверное регулярное выражение {name} '{pattern}' в профиле {profile_name}: {e}")
+
+
+class FilterEngine:
+    # Фильтры профиля, скомпилированные один раз при запуске.
+    # Проверка идет только по заголовкам и останавливается на первом сработавшем правиле
+    RECEIVER_RULE = "receiver_regex_mask"
+    NO_SUBJECT_RULE = "no_subject"
+    ALREADY_IN_DB_RULE = "already_in_db"
+
+    def __init__(self, receiver_regex_mask: str, restricted_subjects_regex: List[str], profile_name: str):
+        self.profile_name = profile_name
+        self.receiver_re = compile_regex(receiver_regex_mask, "receiver_regex_mask", profile_name)
+        self.subject_patterns = list(restricted_subjects_regex or [])
+        self.subject_rules = [compile_regex(pattern, "restricted_subjects_regex", profile_name)
+                              for pattern in self.subject_patterns]
+        self.merged_subject_re = self._merge(self.subject_patterns)
+
+        self._stats = Counter()
+        self._lock = threading.Lock()
+
+    # Профиль передается в дочерние процессы, а Lock не сериализуется
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _merge(patterns: List[str]) -> Optional[Pattern]:
+        if not patterns or any(_NOT_MERGEABLE_RE.search(pattern) for pattern in patterns):
+            return None
+        try:
+            return re.compile("|".join(f"(?P<r{index}>{pattern})" for index, pattern in enumerate(patterns)))
+        except re.error:
+            return None
+
+    def _subject_rule(self, subject: str) -> Optional[str]:
+        subject = subject.lower()
+        rules = zip(self.subject_patterns, self.subject_rules)
+        if self.merged_subject_re is not None:
+            # Общий шаблон быстро отсеивает темы без совпадений. Но он находит самое левое совпадение в теме,
+            # а правило засчитывается первое по порядку в конфиге: оно может совпасть правее
+            match = self.merged_subject_re.search(subject)
+            if match is None:
+                return None
+            matched = next(index for index in range(len(self.subject_patterns))
+                           if match.group(f"r{index}") is not None)
+            rules = itertools.islice(rules, matched + 1)
+
+        for pattern, rule in rules:
+            if rule.search(subject):
+                return pattern
+        return None
+
+    def check(self, receiver: str, subject: Optional[str]) -> Optional[str]:
+        # Возвращает название правила, по которому письмо исключено, или None
+        if not self.receiver_re.search(receiver):
+            rule = self.RECEIVER_RULE
+        elif subject is None:
+            rule = self.NO_SUBJECT_RULE
+        else:
+            subject_rule = self._subject_rule(subject)
+            rule = f"restricted_subjects_regex:{subject_rule}" if subject_rule is not None else None
+
+        if rule is not None:
+            self.count(rule)
+        return rule
+
+    def count(self, rule: str, amount: int = 1):
+        with self._lock:
+            self._stats[rule] += amount
+        Metrics().inc("mails_filtered_total", amount, profile=self.profile_name, rule=rule)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,57 @@
+import io
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+_EXTENSIONS = {"png": "png", "png8": "png", "webp": "webp", "jpeg": "jpg"}
+
+
+@dataclass(frozen=True)
+class ImageEncoding:
+    # Формат картинок письма. png8 - палитра из 256 цветов: скриншоты таблиц на белом фоне почти не теряют в качестве,
+    # а весят в несколько раз меньше полноцветного png. quality - для webp и jpeg
+    format: str = "png"
+    quality: int = 85
+    optimize: bool = True
+
+    def __post_init__(self):
+        if self.format not in _EXTENSIONS:
+            raise ValueError(f"Неизвестный формат картинок {self.format}, допустимы: {', '.join(_EXTENSIONS)}")
+        if not 1 <= self.quality <= 100:
+            raise ValueError(f"image.quality должно быть от 1 до 100, задано {self.quality}")
+
+    @classmethod
+    def from_config(cls, image_conf: dict) -> "ImageEncoding":
+        return cls(format=str(image_conf.get("format", "png")).lower(),
+                   quality=int(image_conf.get("quality", 85)),
+                   optimize=bool(image_conf.get("optimize", True)))
+
+    @property
+    def extension(self) -> str:
+        return _EXTENSIONS[self.format]
+
+    def encode(self, image: "Image.Image") -> bytes:
+        from PIL import Image
+        buffer = io.BytesIO()
+        if self.format == "png8":
+            image.quantize(colors=256, method=Image.Quantize.FASTOCTREE).save(buffer, format="PNG",
+                                                                              optimize=self.optimize)
+        elif self.format == "png":
+            image.save(buffer, format="PNG", optimize=self.optimize)
+        elif self.format == "webp":
+            # method 6 - самое медленное и самое плотное сжатие
+            image.save(buffer, format="WEBP", quality=self.quality, method=6 if self.optimize else 4)
+        else:
+            image.save(buffer, format="JPEG", quality=self.quality, optimize=self.optimize, progressive=self.optimize)
+        return buffer.getvalue()
+
+
+def get_content_height(image: "Image.Image") -> Optional[int]:
+    # Высота без пустого низа: строки одного цвета с последней строкой картинки.
+    # None - картинка целиком одного цвета
+    from PIL import Image, ImageChops
+    background = image.getpixel((0, image.height - 1))
+    bbox = ImageChops.difference(image, Image.new(image.mode, image.size, background)).getbbox()
+    return bbox[3] if bbox is not None else None
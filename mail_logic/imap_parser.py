@@ -0,0 +1,112 @@
+import re
+from typing import Any, Dict, Iterator, List, Tuple, Union
+
+_LITERAL_RE = re.compile(rb"\{(\d+)\}$")
+_DELIMITERS = b" ()"
+
+
+class _Literal(bytes):
+    # Маркер литерала {n}, чтобы отличать его от атомов при разборе
+    pass
+
+
+class _Token:
+    LPAREN = object()
+    RPAREN = object()
+
+
+def _iter_chunks(data: List[Union[bytes, Tuple[bytes, bytes]]]) -> Iterator[Union[bytes, _Literal]]:
+    for item in data:
+        if isinstance(item, tuple):
+            head, literal = item
+            match = _LITERAL_RE.search(head)
+            yield head[:match.start()] if match else head
+            yield _Literal(literal)
+        elif isinstance(item, bytes):
+            yield item
+
+
+def _tokenize_line(line: bytes) -> Iterator[Any]:
+    pos = 0
+    size = len(line)
+    while pos < size:
+        char = line[pos:pos + 1]
+        if char == b" " or char == b"\r" or char == b"\n":
+            pos += 1
+        elif char == b"(":
+            pos += 1
+            yield _Token.LPAREN
+        elif char == b")":
+            pos += 1
+            yield _Token.RPAREN
+        elif char == b'"':
+            pos += 1
+            value = bytearray()
+            while pos < size and line[pos:pos + 1] != b'"':
+                if line[pos:pos + 1] == b"\\":
+                    pos += 1
+                value += line[pos:pos + 1]
+                pos += 1
+            pos += 1
+            yield _Literal(bytes(value))
+        else:
+            start = pos
+            depth = 0
+            while pos < size:
+                char = line[pos:pos + 1]
+                if char == b"[":
+                    depth += 1
+                elif char == b"]":
+                    depth -= 1
+                elif depth == 0 and char in _DELIMITERS:
+                    break
+                pos += 1
+            atom = line[start:pos]
+            yield None if atom.upper() == b"NIL" else atom
+
+
+def _tokenize(data) -> List[Any]:
+    tokens = []
+    for chunk in _iter_chunks(data):
+        if isinstance(chunk, _Literal):
+            tokens.append(chunk)
+        else:
+            tokens.extend(_tokenize_line(chunk))
+    return tokens
+
+
+def _parse_value(tokens: List[Any], pos: int) -> Tuple[Any, int]:
+    token = tokens[pos]
+    if token is _Token.LPAREN:
+        values = []
+        pos += 1
+        while tokens[pos] is not _Token.RPAREN:
+            value, pos = _parse_value(tokens, pos)
+            values.append(value)
+        return values, pos + 1
+    return token, pos + 1
+
+
+def parse_fetch_response(data) -> List[Dict[str, Any]]:
+    # Разбирает ответ FETCH/UID FETCH от imaplib в список словарей {элемент: значение}.
+    # Строки в кавычках и литералы возвращаются как bytes, NIL как None.
+    tokens = _tokenize(data)
+    result = []
+    pos = 0
+    while pos < len(tokens):
+        # <seq> (<item> <value> ...)
+        pos += 1
+        if pos >= len(tokens) or tokens[pos] is not _Token.LPAREN:
+            continue
+        values, pos = _parse_value(tokens, pos)
+        items = {}
+        for i in range(0, len(values) - 1, 2):
+            key = values[i]
+            if isinstance(key, bytes):
+                items[key.decode("ascii", errors="replace").upper()] = values[i + 1]
+        result.append(items)
+    return result
+
+
+def get_uid(items: Dict[str, Any]) -> int:
+    return int(items["UID"])
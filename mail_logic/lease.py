@@ -0,0 +1,164 @@
+import os
+import socket
+import threading
+from typing import Dict, Optional
+
+from common.config_controller import Config
+from database.database import MongoDatabase
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class Lease:
+    # Право одного узла обрабатывать профиль или шард. Пока узел жив, LeaseManager продлевает аренду,
+    # после падения узла она истекает через ttl_sec и ее забирает другой узел
+    def __init__(self, manager: "LeaseManager", key: str):
+        self.manager = manager
+        self.key = key
+        self.held = False
+
+    def acquire(self) -> bool:
+        # Свою аренду продлевает, чужую забирает только после истечения
+        if not self.held and not self.manager.has_capacity(self):
+            return False
+        self.held = self.manager.db_conn.acquire_lease(self.key, self.manager.node_id,
+                                                       self.manager.ttl_sec) is not None
+        if self.held:
+            self.manager.register(self)
+        else:
+            self.manager.unregister(self)
+        return self.held
+
+    def ensure(self):
+        # Перед записью оффсета: если аренду уже забрал другой узел, писать нельзя
+        if not self.renew():
+            raise LeaseLost(f"Аренда {self.key} потеряна узлом {self.manager.node_id}")
+
+    def renew(self) -> bool:
+        self.held = self.manager.db_conn.renew_lease(self.key, self.manager.node_id, self.manager.ttl_sec)
+        if not self.held:
+            self.manager.unregister(self)
+        return self.held
+
+    def release(self):
+        if self.held:
+            self.manager.db_conn.release_lease(self.key, self.manager.node_id)
+            self.held = False
+        self.manager.unregister(self)
+
+
+class LeaseManager:
+    # Распределение профилей между несколькими запущенными экземплярами через коллекцию leases в MongoDB
+    def __init__(self, db_conn: MongoDatabase, node_id: str = None, ttl_sec: float = 60, heartbeat_sec: float = 15):
+        self.db_conn = db_conn
+        self.node_id = node_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.ttl_sec = ttl_sec
+        self.heartbeat_sec = heartbeat_sec
+        self.log = Config.get_common_logger()
+        self._leases: Dict[str, Lease] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # Балансировка (режим daemon): сколько всего аренд делят узлы и сколько узлов живо
+        self._total_keys: Optional[int] = None
+        self._live_nodes = 1
+        self._node_lease = Lease(self, f"node:{self.node_id}")
+
+    @classmethod
+    def from_config(cls, db_conn: MongoDatabase) -> Optional["LeaseManager"]:
+        conf = Config().data.get("coordination") or {}
+        if not conf.get("enabled", False):
+            return None
+        return cls(db_conn, node_id=conf.get("node_id"), ttl_sec=conf.get("lease_ttl_sec", 60),
+                   heartbeat_sec=conf.get("heartbeat_sec", 15))
+
+    def lease(self, key: str) -> Lease:
+        return Lease(self, key)
+
+    def join(self, total_keys: int):
+        # Узел регистрируется в leases и берет не больше своей доли из total_keys аренд,
+        # иначе первый запущенный узел забрал бы все профили
+        self._total_keys = total_keys
+        self._node_lease.acquire()
+        self._refresh_live_nodes()
+        self.log.info(f"Узел {self.node_id} в работе, живых узлов: {self._live_nodes}")
+
+    def has_capacity(self, lease: Lease) -> bool:
+        share = self._get_fair_share()
+        if share is None or lease is self._node_lease:
+            return True
+        with self._lock:
+            return len(self._leases) < share
+
+    def _get_fair_share(self) -> Optional[int]:
+        if self._total_keys is None:
+            return None
+        return -(-self._total_keys // self._live_nodes)
+
+    def _refresh_live_nodes(self):
+        self._live_nodes = max(1, self.db_conn.count_leases("node:"))
+
+    def register(self, lease: Lease):
+        if lease is self._node_lease:
+            self._start_heartbeat()
+            return
+        with self._lock:
+            self._leases[lease.key] = lease
+        self._start_heartbeat()
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._heartbeat, name="lease-heartbeat", daemon=True)
+                self._thread.start()
+
+    def unregister(self, lease: Lease):
+        with self._lock:
+            if self._leases.get(lease.key) is lease:
+                del self._leases[lease.key]
+
+    def close(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            leases = list(self._leases.values())
+        for lease in leases + [self._node_lease]:
+            try:
+                lease.release()
+            except Exception as e:
+                self.log.warning(f"Не удалось освободить аренду {lease.key}", exc_info=e)
+
+    def _heartbeat(self):
+        while not self._stop_event.wait(self.heartbeat_sec):
+            with self._lock:
+                leases = list(self._leases.values())
+            if self._node_lease.held:
+                leases.append(self._node_lease)
+            for lease in leases:
+                try:
+                    if not lease.renew():
+                        self.log.warning(f"Аренду {lease.key} забрал другой узел")
+                except Exception as e:
+                    # Аренда истечет сама, если MongoDB недоступна дольше ttl_sec
+                    self.log.warning(f"Не удалось продлить аренду {lease.key}", exc_info=e)
+            if self._total_keys is not None:
+                try:
+                    self._rebalance()
+                except Exception as e:
+                    self.log.warning("Не удалось проверить число живых узлов", exc_info=e)
+
+    def _rebalance(self):
+        if not self._node_lease.held:
+            # Регистрация узла истекла, например MongoDB была недоступна
+            self._node_lease.acquire()
+        self._refresh_live_nodes()
+        share = self._get_fair_share()
+        with self._lock:
+            excess = list(self._leases.values())[share:]
+        # По одной аренде за раз, чтобы новые узлы успевали забирать освободившиеся профили
+        if excess:
+            self.log.info(f"Узлов стало {self._live_nodes}, аренда {excess[-1].key} отдается другому узлу")
+            excess[-1].release()
@@ -1,41 +1,83 @@
 import datetime
-import email
-import os
-import random
+import email.utils
 import re
-import string
-from dataclasses import dataclass
-from email import policy
 from email.header import decode_header
 from email.message import Message
-from sys import platform
 from typing import List, Optional, Union, Type
 
-import chardet
-import imgkit
-from PIL import Image
-
 from common.config_controller import Config
+from .attachment_store import AttachmentStore, AttachmentStoreError, get_attachment_filename
+from .decoding import CharsetDecoder, unescape_unicode
+from .normalizer import BodyNormalizer
+
+_UNSET = object()
+
+
+class _LazyField:
+    # Поле MailData, которое вычисляется методом MailBuilder при первом обращении
+    def __init__(self, compute: str):
+        self.compute = compute
+
+    def __set_name__(self, owner, name):
+        self.slot = "_" + name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = getattr(instance, self.slot)
+        if value is _UNSET:
+            builder = instance._builder
+            value = getattr(builder, self.compute)() if builder is not None else None
+            setattr(instance, self.slot, value)
+        return value
+
+    def __set__(self, instance, value):
+        setattr(instance, self.slot, value)
+
 
-@dataclass
 class MailData:
-    raw_data: Message
-    id: str
-    date: str
-    body: str
-    subject: str
-    sender: str
-    receiver: str
-    folder: str
-
-    attachments: List[str] = ()
-    is_sent: bool = False
-    converted_to_image: bool = False
+    # Запись о письме без __dict__: таких записей в памяти до bulk_write тысячи.
+    # Поля из заголовков и тело раскодируются при первом обращении, фильтрам по заголовкам нужны не все
+    __slots__ = ("raw_data", "id", "folder", "attachments", "attachments_meta", "image_tiles", "is_sent",
+                 "converted_to_image", "render_failed", "_builder", "_date", "_body", "_subject", "_sender", "_receiver")
+    _LAZY_FIELDS = ("date", "body", "subject", "sender", "receiver")
+
+    date = _LazyField("_get_email_date")
+    body = _LazyField("_get_mail_body")
+    subject = _LazyField("_get_mail_subject")
+    sender = _LazyField("_get_mail_sender")
+    receiver = _LazyField("_get_mail_receiver")
+
+    def __init__(self, raw_data: Optional[Message], id: str, folder: str, builder: "MailBuilder" = None, **fields):
+        # raw_data освобождается после сохранения вложений
+        self.raw_data = raw_data
+        self.id = id
+        self.folder = folder
+        self._builder = builder
+        for name in self._LAZY_FIELDS:
+            setattr(self, "_" + name, _UNSET)
+        self.attachments: List[str] = []
+        # Сведения о сохраненных вложениях: исходное имя файла, хэш, размер
+        self.attachments_meta: List[dict] = []
+        # Картинки письма из html: путь, формат, ширина, высота и размер файла
+        self.image_tiles: List[dict] = []
+        self.is_sent = False
+        self.converted_to_image = False
+        self.render_failed = False
+        for name, value in fields.items():
+            setattr(self, name, value)
 
     @classmethod
     def get_builder(cls):
         return MailBuilder
 
+    def load(self) -> "MailData":
+        # Раскодирует все поля сразу: ошибки разбора письма возникают на этапе build, а не при записи в БД
+        for name in self._LAZY_FIELDS:
+            getattr(self, name)
+        self._builder = None
+        return self
+
     def to_dict(self):
         return {
             "id": self.id,
@@ -47,43 +89,59 @@ class MailData:
             "folder": self.folder,
             "is_sent": self.is_sent,
             "converted_to_image": self.converted_to_image,
-            "attachments": self.attachments
+            "render_failed": self.render_failed,
+            "attachments": self.attachments,
+            "attachments_meta": self.attachments_meta,
+            "image_tiles": self.image_tiles
         }
 
 
 class MailBuilder:
+    _charset_decoder = CharsetDecoder()
+
     def __init__(self, raw_mail: Message, folder: str, mail_id: str, force_to_image: bool = False,
-                 replacements: List[dict] = None):
+                 replacements: List[dict] = None, normalizer: BodyNormalizer = None):
         self.raw_data = raw_mail
         self.force_to_image = force_to_image
         self.folder = folder
         self.mail_id = mail_id
         self.replacements = replacements or []
+        self.normalizer = normalizer or BodyNormalizer()
 
         self.log = Config.get_common_logger()
 
-    def build(self) -> MailData:
-        return MailData(raw_data=self.raw_data,
-                        folder=self.folder,
-                        id=self.folder + self.mail_id,
-                        subject=self._get_mail_subject(),
-                        date=self._get_email_date(),
-                        sender=self._get_mail_sender(),
-                        receiver=self._get_mail_receiver(),
-                        body=self._get_mail_body(),
-                        )
+    def build(self, with_body: bool = True) -> MailData:
+        # Поля вычисляются при первом обращении, см. MailData.load.
+        # with_body=False - только поля из заголовков, для фильтрации до скачивания письма целиком
+        mail_data = MailData(raw_data=self.raw_data,
+                             folder=self.folder,
+                             id=self.mail_id,
+                             builder=self)
+        if not with_body:
+            mail_data.body = None
+        return mail_data
 
     def _get_email_date(self) -> str:
         _date = self.raw_data["Date"]
+        if _date is None:
+            raise Exception('У письма нет заголовка Date')
+        _date = str(_date)
+        # Почти все письма в формате RFC 5322, старые шаблоны - для нестандартных дат
+        try:
+            dt_email = email.utils.parsedate_to_datetime(_date).strftime("%Y-%m-%d %H:%M:%S")
+        except (TypeError, ValueError, IndexError):
+            dt_email = None
+
         list_for_check_formats = [
             {'input_date': _date, "from_format": "%d %b %Y %H:%M:%S %z"},
             {'input_date': _date[:25], "from_format": "%a, %d %b %Y %H:%M:%S"},
             {'input_date': _date[:30], "from_format": "%a, %d %b %Y %H:%M:%S %z"},
             {'input_date': _date[:31], "from_format": "%a, %d %b %Y %H:%M:%S %z"},
         ]
-        dt_email = None
         for case in list_for_check_formats:
-            dt_email = dt_email or self._convert_date(case['input_date'], case['from_format'])
+            if dt_email is not None:
+                break
+            dt_email = self._convert_date(case['input_date'], case['from_format'])
 
         if dt_email is None:
             raise Exception(f'Формат даты {_date} письма не соответствует ни одному указанному шаблону даты')
@@ -99,90 +157,58 @@ class MailBuilder:
 
     def _get_mail_body(self) -> str:
         if self.force_to_image:
-            content = self._get_mail_body_like_html(self.raw_data)
+            part = self._get_mail_body_part_like_html(self.raw_data)
         else:
-            content = self._get_mail_body_like_plaint_text(self.raw_data)
+            part = self._get_mail_body_part_like_plaint_text(self.raw_data)
 
-        content = self._decode_bytes(content)
+        content = self._decode_bytes(part.get_payload(decode=True), part.get_content_charset())
 
-        content = self._base_replacements(content)
+        content = self.normalizer.normalize(content)
         content = self.replace_re_substring(content, self.replacements)
         return content
 
-    def _decode_bytes(self, content: Union[bytes, str]):
+    def _decode_bytes(self, content: Union[bytes, str], charset: Optional[str] = None):
         try:
             if isinstance(content, bytes):
-                enc = chardet.detect(content)
-                encoding = enc["encoding"]
-                if enc["confidence"] < 0.5:
-                    encoding = "utf-8"
-                content = content.decode(encoding=encoding)
-
-            if content.find('\\u') != -1:
-                content = content.encode('utf-8').decode('unicode-escape')
-            return content
+                content = self._charset_decoder.decode(content, charset, sender=str(self.raw_data.get("From") or ""))
+            return unescape_unicode(content)
 
         except Exception as e:
-            self.log.error(f"Не удалось определить верно кодировку {enc} для {content[:1000]} ", exc_info=e)
+            self.log.error(f"Не удалось определить верно кодировку {charset} для {content[:1000]} ", exc_info=e)
 
     @staticmethod
-    def _get_mail_body_like_plaint_text(mail_data: Message) -> bytes:
+    def _get_mail_body_part_like_plaint_text(mail_data: Message) -> Message:
         while mail_data.is_multipart():
             mail_data = mail_data.get_payload(0)
-        return mail_data.get_payload(decode=True)
+        return mail_data
 
     @staticmethod
-    def _get_mail_body_like_html(mail_data: Message) -> bytes:
+    def _get_mail_body_part_like_html(mail_data: Message) -> Message:
         try:
             while mail_data.is_multipart():
                 mail_data = mail_data.get_payload(1)
-            return mail_data.get_payload(decode=True)
+            return mail_data
         except IndexError as e:
             Config.get_common_logger().warning("Отключите force_image.")
-            return MailBuilder._get_mail_body_like_plaint_text(mail_data)
-
+            return MailBuilder._get_mail_body_part_like_plaint_text(mail_data)
 
     def _get_mail_subject(self) -> str:
         email_data = self.raw_data
         current_subject = email_data.get("Subject") or ""
-        encoded_subject = decode_header(current_subject)[0][0]
-        return self._decode_bytes(encoded_subject)
+        encoded_subject, charset = decode_header(current_subject)[0]
+        return self._decode_bytes(encoded_subject, charset)
 
-    def _get_mail_sender(self):
-        sender = self.raw_data.get("From") or ""
-        self.log.debug("Mail sender is: " + str(sender))
+    def _get_mail_sender(self) -> str:
+        # Заголовок с 8-битными байтами email возвращает объектом Header, а не строкой
+        sender = str(self.raw_data.get("From") or "")
+        self.log.debug("Mail sender is: " + sender)
         return sender
 
-    def _get_mail_receiver(self):
-        receiver = self.raw_data.get("To") or ""
+    def _get_mail_receiver(self) -> str:
+        receiver = str(self.raw_data.get("To") or "")
         self.log.debug(f"Mail receiver is {receiver}")
         return receiver.lower()
 
-    @staticmethod
-    def _random_word(length):
-        letters = string.ascii_lowercase
-        return ''.join(random.choice(letters) for i in range(length))
-
-    @staticmethod
-    def _base_replacements(body: str) -> str:
-        mail_body = body
-        mail_body = str(email.message_from_string(mail_body, policy=policy.default))
-        new_list = []
-        count = 1
-        row_list = mail_body.split('\n')
-        for row in row_list:
-            row.replace('\r', '')
-            match_attach = re.search(r'\[cid:.*\]', row)
-            if match_attach:
-                row = '[Вложение ' + str(count) + ']'
-                count += 1
-            if row.find('*From:*') != -1 or row.find('From: ') != -1:
-                break
-            if row != '':
-                new_list.append(row)
-        body = '\n'.join(new_list)
-        return body
-
     @staticmethod
     def replace_re_substring(text: str, list_dict_pattern_substr: List[dict]):
         for dict_pattern_substr in list_dict_pattern_substr:
@@ -197,80 +223,38 @@ class MailBuilder:
         return (text.find("<html") != -1 and text.find("</html>") != -1) or text.find("<br>") != -1
 
     @classmethod
-    def html_message_to_image(cls, data: MailData, store_path, max_height: int = 1200, max_width: int = 600):
-        text = data.body
-        path = os.path.join(store_path, cls._random_word(10) + ".png")
-        text = re.sub('<img[^>]*>', '', text)
-        text = re.sub('<img>[^>]*</img>', '', text)
-        text = text.replace('src="cid:', 'src="')
-        text = f"<html><style> html{{width: {max_width}px !important;}}</style>" + text + "</html>"
-
-        Config.get_common_logger().debug(f"HTML to image: {text}")
-        options = {
-            'width': max_width,
-            'encoding': 'UTF-8',
-            '--disable-smart-width': ""
-        }
-        if platform == "win32":
-            config = imgkit.config(wkhtmltoimage=r'C:\Program Files\wkhtmltopdf\bin\wkhtmltoimage.exe')
-
-            imgkit.from_string(text, path, config=config, options=options)
-        else:
-            imgkit.from_string(text, path, options=options)
-
-        input_image = Image.open(path)
-        _path = path
-        image_width, image_height = input_image.size
-
-        # Обрезание по высоте слишком длинных писем
-        _new = False
-        if image_height > max_height:
-            for y in range(0, image_height, max_height):
-                _new = True
-                upper = y
-                lower = y + max_height
-                # Crop the tile from the original image
-                tile = input_image.crop((0, upper, image_width, lower))
-
-                # Save the tile as a separate image
-                path = path.replace(".png", "")
-                path = f'{path}_{y}.png'
-                tile.save(path)
-                data.attachments.append(path)
+    def apply_image(cls, data: MailData, tiles: List[dict]):
+        image_paths = [tile["path"] for tile in tiles]
+        data.image_tiles = tiles
+        if len(image_paths) > 1:
+            data.attachments.extend(image_paths)
         else:
-            data.attachments.insert(0, path)
-
-        input_image.close()
-        if _new:
-            os.remove(_path)
+            data.attachments.insert(0, image_paths[0])
 
         data.converted_to_image = True
         data.body = "Выгружено в изображение"
 
     @classmethod
-    def save_attachment(cls, email_data: MailData, store_path):
-        att_paths = []
+    def save_attachment(cls, email_data: MailData, store: AttachmentStore):
+        att_refs = []
 
         for part in email_data.raw_data.walk():
-            if part.get_content_maintype() == 'multipart':
-                continue
-            if part.get('Content-Disposition') is None:
-                continue
-
-            filename = part.get_filename()
+            filename = get_attachment_filename(part)
             if filename is None:
                 continue
-            if filename.find('=?utf-8?') != -1:
+            # Большие вложения уже записаны в хранилище при скачивании письма
+            stored_ref = getattr(part, "stored_ref", None)
+            if stored_ref is not None:
+                att_refs.append(stored_ref)
                 continue
-            att_path = os.path.join(store_path, filename)
-
-            if os.path.isfile(att_path):
-                att_path = os.path.join(store_path, f"{cls._random_word(10)}_{filename}")
+            if getattr(part, "streamed", False):
+                # Вместо содержимого пустая заглушка: письмо не должно записаться без вложения
+                raise AttachmentStoreError(f"Вложение {filename} письма {email_data.id} не скачано")
             try:
-                with open(att_path, 'wb') as fp:
-                    fp.write(part.get_payload(decode=True))
-                att_paths.append(att_path)
-            except:
-                pass
+                att_refs.append(store.save_part(part, filename))
+            except Exception as e:
+                Config.get_common_logger().warning(f"Не удалось сохранить вложение {filename} письма {email_data.id}",
+                                                   exc_info=e)
 
-        email_data.attachments = att_paths
+        email_data.attachments = [ref["path"] for ref in att_refs]
+        email_data.attachments_meta = att_refs
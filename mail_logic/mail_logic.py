@@ -1,130 +1,657 @@
+import datetime
+import itertools
+import os
 import re
+import select
+import ssl
+import threading
+import time
+from contextlib import contextmanager
 from email.message import Message
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union, TYPE_CHECKING
 
 import email
-from imaplib import IMAP4_SSL
+from imaplib import IMAP4, IMAP4_SSL, IMAP4_SSL_PORT
 from common.config_controller import Config
+from common.metrics import Metrics
 from database.database import MongoDatabase
+from .attachment_store import AttachmentStore, AttachmentStoreError, get_attachment_filename, is_streamable
+from .body_structure import BodyPart
+from .checkpoint import OffsetCheckpoint, ShardCheckpoint
+from .filters import FilterEngine
+from .imap_parser import parse_fetch_response, get_uid
+from .lease import LeaseManager
 from .mail_builder import MailData, MailBuilder
+from .pipeline import OffsetTracker, Pipeline
 from .profile import ConfigProfile
+from .render import RenderPool
+from .streaming import FetchLimits, MessageTooLarge, parse_chunks
+
+if TYPE_CHECKING:
+    from .connection_pool import ImapConnectionPool
+
+HEADER_FIELDS = "BODY.PEEK[HEADER.FIELDS (TO FROM SUBJECT DATE MESSAGE-ID)]"
+# Серверы разрывают IDLE через 30 минут, поэтому переподключаемся раньше
+IDLE_MAX_SECONDS = 25 * 60
+_EXISTS_RE = re.compile(rb"\* (\d+) EXISTS")
+_STATUS_ITEM_RE = re.compile(rb"(UIDNEXT|UIDVALIDITY) (\d+)")
+_MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+def _imap_date(value: datetime.date) -> str:
+    # Формат даты IMAP (RFC 3501) не должен зависеть от локали, поэтому без strftime("%b")
+    return f"{value.day}-{_MONTHS[value.month - 1]}-{value.year}"
 
 
 class EmailConnection(IMAP4_SSL):
-    def __init__(self, imap_host, login, passw):
-        super().__init__(host=imap_host)
+    def __init__(self, imap_host, login, passw, port: int = IMAP4_SSL_PORT, use_ssl: bool = True):
+        # Без SSL - только для локальных серверов, например в бенчмарках
+        self.use_ssl = use_ssl
+        super().__init__(host=imap_host, port=port)
         self.login(user=login, password=passw)
+        # Число писем выбранной папки, известное клиенту: с ним сравниваются EXISTS, пришедшие между командами
+        self.exists_count: Optional[int] = None
 
         self.log = Config.get_common_logger()
         self.log.info(f"The connection was established.")
 
-    def get_last_id_in_folder(self, folder) -> bytes:
-        self.log.info(f"Getting last letter id from folder {folder}...")
-        status, last_id = self.select(folder, readonly=True)
+    def _create_socket(self, timeout):
+        if self.use_ssl:
+            return super()._create_socket(timeout)
+        return IMAP4._create_socket(self, timeout)
+
+    def supports_idle(self) -> bool:
+        return "IDLE" in self.capabilities
+
+    def idle(self, timeout: float, stop_event: threading.Event = None) -> bool:
+        # IMAP IDLE (RFC 2177): ждем от сервера уведомления о новых письмах в выбранной папке.
+        # Возвращает True, если пришло новое письмо
+        if self._has_new_untagged_exists():
+            return True
+        tag = self._new_tag()
+        self.send(tag + b" IDLE\r\n")
+        response = self.readline()
+        if not response.startswith(b"+"):
+            raise self.error(f"Сервер не принял IDLE: {response!r}")
+
+        has_new_mail = False
+        deadline = time.monotonic() + min(timeout, IDLE_MAX_SECONDS)
+        try:
+            while time.monotonic() < deadline and not (stop_event is not None and stop_event.is_set()):
+                # Ждем данных не дольше секунды, чтобы вовремя заметить сигнал остановки
+                if not self._has_buffered_data() and not select.select([self.sock], [], [], 1)[0]:
+                    continue
+                line = self.readline()
+                if not line:
+                    raise self.abort("Соединение закрыто сервером во время IDLE")
+                if self._match_exists(line):
+                    has_new_mail = True
+                    break
+        finally:
+            self.send(b"DONE\r\n")
+            while True:
+                line = self.readline()
+                if not line:
+                    raise self.abort("Соединение закрыто сервером во время IDLE")
+                if self._match_exists(line):
+                    has_new_mail = True
+                if line.startswith(tag):
+                    break
+            self.tagged_commands.pop(tag, None)
+        return has_new_mail
+
+    def _has_new_untagged_exists(self) -> bool:
+        # EXISTS, пришедший во время FETCH прошлого прохода, imaplib уже прочитал и отложил в untagged_responses:
+        # в IDLE сервер его не повторит
+        exists = self.untagged_responses.pop("EXISTS", None)
+        expunged = self.untagged_responses.pop("EXPUNGE", None) or []
+        if self.exists_count is None:
+            return bool(exists)
+        known_count = self.exists_count - len(expunged)
+        self.exists_count = int(exists[-1]) if exists else known_count
+        return self.exists_count > known_count
+
+    def _match_exists(self, line: bytes) -> bool:
+        match = _EXISTS_RE.match(line)
+        if match is None:
+            return False
+        self.exists_count = int(match[1])
+        return True
+
+    def _has_buffered_data(self) -> bool:
+        # Строки, которые imaplib уже прочитал из сокета в буфер self.file (например, EXISTS в одном пакете
+        # с "+ idling"), select на сокете не увидит. peek без блокировки читает только то, что уже пришло
+        timeout = self.sock.gettimeout()
+        self.sock.setblocking(False)
+        try:
+            return bool(self.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            self.sock.settimeout(timeout)
+
+    def select_folder(self, folder) -> Tuple[int, int]:
+        # Возвращает UIDVALIDITY папки и UID последнего письма в ней
+        self.log.info(f"Getting last letter uid from folder {folder}...")
+        status, exists = self.select(folder, readonly=True)
+        if status != "OK":
+            raise Exception(f"Got status {status} while selecting {folder} folder")
+        self.exists_count = int(exists[0])
+
+        _, uidvalidity = self.response("UIDVALIDITY")
+        if not uidvalidity or uidvalidity[0] is None:
+            raise Exception(f"Сервер не вернул UIDVALIDITY для папки {folder}")
+
+        last_uid = self.get_uid_by_seq("*", folder) if self.exists_count > 0 else 0
+        return int(uidvalidity[0]), last_uid
+
+    def get_status(self, folder) -> Tuple[int, int]:
+        # UIDVALIDITY и UIDNEXT папки без SELECT: по ним видно, пришли ли новые письма
+        status, data = self.status(folder, "(UIDNEXT UIDVALIDITY)")
         if status != "OK":
-            raise Exception(f"Got status {status} while getting last id in {folder} folder")
+            raise Exception(f"Got status {status} while getting status of {folder} folder")
+        items = dict(_STATUS_ITEM_RE.findall(b" ".join(item for item in data if isinstance(item, bytes))))
+        if b"UIDNEXT" not in items or b"UIDVALIDITY" not in items:
+            raise Exception(f"Сервер не вернул UIDNEXT и UIDVALIDITY для папки {folder}")
+        return int(items[b"UIDVALIDITY"]), int(items[b"UIDNEXT"])
 
-        return last_id[0]
+    def get_uid_by_seq(self, seq: Union[int, str], folder) -> int:
+        status, data = self.fetch(str(seq), "(UID)")
+        if status != "OK":
+            raise Exception(f"Got status {status} while getting uid of message {seq} in {folder} folder")
+        for items in parse_fetch_response(data):
+            if "UID" in items:
+                return get_uid(items)
+        raise Exception(f"Не удалось получить uid письма {seq} в папке {folder}")
 
-    def get_mail_by_id(self, mail_id: int, folder) -> Message:
-        self.log.info(f"Getting mail data for id {mail_id} in {folder} folder ")
-        status, data = self.fetch(message_set=str(mail_id), message_parts="(RFC822)")
+    def search_uids(self, folder, since: datetime.date = None, before: datetime.date = None) -> List[int]:
+        # UID писем выбранной папки по дате получения (INTERNALDATE): since включительно, before - нет
+        criteria = []
+        if since is not None:
+            criteria += ["SINCE", _imap_date(since)]
+        if before is not None:
+            criteria += ["BEFORE", _imap_date(before)]
+        status, data = self.uid("SEARCH", *(criteria or ["ALL"]))
         if status != "OK":
-            raise Exception(f"Got status {status} while getting message by id {mail_id} in {folder} folder")
-        raw_email = data[0][1]
+            raise Exception(f"Got status {status} while searching {' '.join(criteria)} in {folder} folder")
+        return sorted(int(uid) for line in data if line for uid in line.split())
 
-        return email.message_from_bytes(raw_email)
+    def iter_headers(self, first_uid: int, last_uid: int, folder,
+                     batch_size: int = 100) -> Iterator[Tuple[int, List["MailHeaders"]]]:
+        # Первый проход: только заголовки для фильтров и BODYSTRUCTURE, без тела и вложений
+        for batch_start in range(first_uid, last_uid + 1, batch_size):
+            batch_end = min(batch_start + batch_size - 1, last_uid)
+            self.log.info(f"Getting headers with uid {batch_start}:{batch_end} in {folder} folder")
+            status, data = self.uid("FETCH", f"{batch_start}:{batch_end}", f"(UID {HEADER_FIELDS} BODYSTRUCTURE)")
+            if status != "OK":
+                raise Exception(f"Got status {status} while getting headers {batch_start}:{batch_end} "
+                                f"in {folder} folder")
+
+            batch = []
+            for items in parse_fetch_response(data):
+                if "UID" not in items:
+                    continue
+                uid = get_uid(items)
+                header_bytes = next((value for key, value in items.items() if key.startswith("BODY[HEADER")), b"")
+                structure = None
+                try:
+                    if items.get("BODYSTRUCTURE"):
+                        structure = BodyPart.parse(items["BODYSTRUCTURE"])
+                except Exception as e:
+                    self.log.warning(f"Не удалось разобрать BODYSTRUCTURE письма {uid} в папке {folder}", exc_info=e)
+                batch.append(MailHeaders(uid=uid,
+                                         headers=email.message_from_bytes(header_bytes or b""),
+                                         structure=structure))
+            batch.sort(key=lambda mail: mail.uid)
+            yield batch_end, batch
+
+    def iter_bodies(self, mails: List["MailHeaders"], folder, force_to_image: bool = False,
+                    store: AttachmentStore = None, limits: FetchLimits = None,
+                    on_error: Callable[[int, Exception], None] = None) -> Iterator[Tuple[int, Message]]:
+        # Второй проход: только те MIME-части, которые будут использованы MailBuilder.
+        # Большие вложения скачиваются частями сразу в store, в памяти остаются тело письма и мелкие вложения.
+        # Письма больше limits.max_message_size передаются в on_error (без него - исключение)
+        limits = limits or FetchLimits()
+        by_sections: Dict[Tuple[str, ...], List[Tuple[MailHeaders, int, List[BodyPart]]]] = {}
+        full_fetch = []
+        for mail in mails:
+            if mail.structure is None:
+                full_fetch.append(mail.uid)
+                continue
+            try:
+                in_memory, streamed = self._plan_fetch(mail.structure, force_to_image, limits, store)
+            except MessageTooLarge as e:
+                self._handle_mail_error(mail.uid, e, on_error)
+                continue
+            by_sections.setdefault(tuple(part.section for part in in_memory), []).append(
+                    (mail, sum(part.size for part in in_memory), streamed))
+
+        for sections, group in by_sections.items():
+            # Ответ на один FETCH целиком в памяти, поэтому пачки писем ограничены тем же лимитом
+            for batch in self._split_by_size(group, limits.max_message_size):
+                payloads = self._fetch_sections([mail.uid for mail, _, _ in batch], sections, folder)
+                for mail, _, streamed in batch:
+                    if mail.uid not in payloads:
+                        continue
+                    message = mail.structure.to_message(payloads.pop(mail.uid), root=mail.headers)
+                    if streamed:
+                        # Ошибки сети не перехватываются: пачка не записывается, письмо скачается повторно
+                        try:
+                            self._save_streamed_parts(mail.uid, mail.structure, message, streamed, folder, store,
+                                                      limits.chunk_size)
+                        except AttachmentStoreError as e:
+                            self._handle_mail_error(mail.uid, e, on_error)
+                            continue
+                    yield mail.uid, message
+
+        if full_fetch:
+            yield from self.iter_full_mails(full_fetch, folder, store=store, limits=limits, on_error=on_error)
+
+    def iter_full_mails(self, uids: List[int], folder, store: AttachmentStore = None, limits: FetchLimits = None,
+                        on_error: Callable[[int, Exception], None] = None) -> Iterator[Tuple[int, Message]]:
+        # Письма без BODYSTRUCTURE: BODY.PEEK[] частями через BytesFeedParser, вложения сразу пишутся в store
+        limits = limits or FetchLimits()
+        for uid in uids:
+            self.log.info(f"Getting full mail {uid} in {folder} folder")
+            chunks = self.iter_section_chunks(uid, "", folder, limits.chunk_size)
+            first_chunk = next(chunks, None)
+            if first_chunk is None:
+                continue
+            try:
+                message = parse_chunks(itertools.chain([first_chunk], chunks), store, limits.max_message_size)
+            except MessageTooLarge as e:
+                self._handle_mail_error(uid, e, on_error)
+                continue
+            yield uid, message
+
+    def iter_section_chunks(self, uid: int, section: str, folder, chunk_size: int) -> Iterator[bytes]:
+        # BODY.PEEK[section]<offset.length>: ни один ответ сервера не больше chunk_size
+        offset = 0
+        while True:
+            status, data = self.uid("FETCH", str(uid), f"(UID BODY.PEEK[{section}]<{offset}.{chunk_size}>)")
+            if status != "OK":
+                raise Exception(f"Got status {status} while getting part {section} of message {uid} "
+                                f"in {folder} folder")
+            chunk = None
+            for items in parse_fetch_response(data):
+                if "UID" in items and get_uid(items) == uid:
+                    chunk = next((value for key, value in items.items() if key.startswith("BODY[")), None) or b""
+            if chunk is None:
+                # Письмо удалено с сервера
+                return
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                return
+            offset += len(chunk)
+
+    @staticmethod
+    def _plan_fetch(structure: BodyPart, force_to_image: bool, limits: FetchLimits,
+                    store: Optional[AttachmentStore]) -> Tuple[List[BodyPart], List[BodyPart]]:
+        # Какие части скачать в памяти одним FETCH, а какие частями сразу в хранилище вложений
+        body = structure.find_body_part(force_to_image)
+        if body.size > limits.max_message_size:
+            raise MessageTooLarge(f"Часть {body.section} с телом письма ({body.size} байт) больше лимита "
+                                  f"{limits.max_message_size} байт")
+        in_memory, streamed, size = [body], [], body.size
+        for part in structure.attachment_parts():
+            if part.section == body.section:
+                continue
+            if (store is not None and is_streamable(part.encoding)
+                    and (part.size > limits.chunk_size or size + part.size > limits.max_message_size)):
+                streamed.append(part)
+            else:
+                in_memory.append(part)
+                size += part.size
+        return in_memory, streamed
+
+    @staticmethod
+    def _split_by_size(group: List[tuple], max_size: int) -> Iterator[List[tuple]]:
+        batch, batch_size = [], 0
+        for item in group:
+            if batch and batch_size + item[1] > max_size:
+                yield batch
+                batch, batch_size = [], 0
+            batch.append(item)
+            batch_size += item[1]
+        if batch:
+            yield batch
+
+    def _fetch_sections(self, uids: List[int], sections: Tuple[str, ...], folder) -> Dict[int, Dict[str, bytes]]:
+        uid_set = ",".join(str(uid) for uid in uids)
+        parts = " ".join(f"BODY.PEEK[{section}]" for section in sections)
+        self.log.info(f"Getting parts {sections} of mails {uid_set} in {folder} folder")
+        status, data = self.uid("FETCH", uid_set, f"(UID {parts})")
+        if status != "OK":
+            raise Exception(f"Got status {status} while getting parts of messages {uid_set} in {folder} folder")
+        payloads = {}
+        for items in parse_fetch_response(data):
+            if "UID" in items:
+                payloads[get_uid(items)] = {key[5:-1]: value for key, value in items.items()
+                                            if key.startswith("BODY[") and key.endswith("]")
+                                            and isinstance(value, bytes)}
+        return payloads
+
+    def _save_streamed_parts(self, uid: int, structure: BodyPart, message: Message, streamed: List[BodyPart],
+                             folder, store: AttachmentStore, chunk_size: int):
+        # to_message строит дерево той же формы, что и BODYSTRUCTURE, поэтому обход идет параллельно
+        sections = {part.section for part in streamed}
+        for part, part_message in zip(structure.walk(), message.walk()):
+            if part.section not in sections:
+                continue
+            filename = get_attachment_filename(part_message)
+            self.log.info(f"Saving attachment {part.section} ({part.size} bytes) of mail {uid} in {folder} folder")
+            # В дереве письма у такой части пустое содержимое, сохранить ее можно только по stored_ref
+            part_message.streamed = True
+            part_message.stored_ref = store.save_chunks(
+                    self.iter_section_chunks(uid, part.section, folder, chunk_size),
+                    filename, part_message.get_content_type(), part.encoding)
+
+    def _handle_mail_error(self, uid: int, error: Exception, on_error: Optional[Callable[[int, Exception], None]]):
+        if on_error is None:
+            raise error
+        on_error(uid, error)
+
+
+@dataclass
+class MailTask:
+    # Письмо на этапах конвейера: сначала исходное сообщение, после разбора - MailData
+    uid: int
+    raw_mail: Optional[Message]
+    mail_data: Optional[MailData] = None
+
+
+@dataclass
+class MailHeaders:
+    uid: int
+    headers: Message
+    structure: Optional[BodyPart]
 
 
 class MailFacade:
-    def __init__(self, profile: ConfigProfile):
+    def __init__(self, profile: ConfigProfile, db_conn: MongoDatabase = None, render_pool: RenderPool = None,
+                 stop_event: threading.Event = None, connection_pool: "ImapConnectionPool" = None,
+                 hold_connection: bool = False, checkpoint: Union[OffsetCheckpoint, ShardCheckpoint] = None,
+                 leases: LeaseManager = None, stage_workers: int = None):
         conf = Config()
         self.profile = profile
         self.folder = self.profile.folder
         self.log = Config.get_common_logger()
         self.attachments_path = conf.attachment_path
-        self.db_conn = MongoDatabase()
-
-        self.email_connect = EmailConnection(self.profile.imap_host, self.profile.login, self.profile.passw)
-        last_id = int(self.email_connect.get_last_id_in_folder(self.folder))
-
-        amount_offset_data = self.db_conn.table("offset_folder").count_documents({"folder": self.folder})
-        if amount_offset_data > 1:
-            raise Exception(f"Два оффсета у одной папки {self.folder} в БД")
-
-        if amount_offset_data == 0:
-            _offset_dict = {"_id": self.folder,
-                            'folder': self.folder,
-                            'offset': last_id
-                            }
-            self.db_conn.table("offset_folder").insert_one(_offset_dict)
-            self.log.info(f'Инициирован оффсет для папки {self.folder}')
-
-        offset_data = self.db_conn.table("offset_folder").find({"folder": self.folder})
-        offset = int(offset_data[0]['offset'])
-        if offset == last_id:
+        self.db_conn = db_conn or MongoDatabase()
+        # По умолчанию - оффсет профиля, для исторической выгрузки - прогресс шарда
+        self.checkpoint = checkpoint or OffsetCheckpoint(self.db_conn, profile)
+        # Несколько экземпляров: папку или шард обрабатывает только узел, который держит аренду
+        self.lease = leases.lease(self.checkpoint.lease_key) if leases is not None else None
+        # Пул рендера может быть общим для нескольких профилей, тогда его закрывает владелец
+        self._owns_render_pool = render_pool is None
+        self.render_pool = render_pool or RenderPool.from_config(self.attachments_path)
+        self.attachment_store = AttachmentStore(os.path.join(self.attachments_path, "store"))
+        self.fetch_limits = FetchLimits.from_config()
+        self.metrics = Metrics()
+        self.stop_event = stop_event or threading.Event()
+        self.connection_pool = connection_pool
+        self.hold_connection = hold_connection
+        # Число потоков каждого этапа конвейера вместо pipeline.stages.*.workers
+        self.stage_workers = stage_workers
+        self.email_connect: Optional[EmailConnection] = None
+        self.uidvalidity = None
+        self._offsets: Optional[OffsetTracker] = None
+        self._pipeline_error: Optional[Exception] = None
+        self.stage_stats: Dict[str, dict] = {}
+
+    @contextmanager
+    def _borrow_connection(self) -> Iterator[EmailConnection]:
+        # Без пула и при hold_connection соединение держится до close(), иначе берется из пула на один проход
+        if self.email_connect is None and self.connection_pool is None:
+            self.email_connect = EmailConnection(self.profile.imap_host, self.profile.login, self.profile.passw,
+                                                 port=self.profile.imap_port, use_ssl=self.profile.use_ssl)
+        elif self.email_connect is None and self.hold_connection:
+            self.email_connect = self.connection_pool.borrow()
+
+        if self.email_connect is not None:
+            yield self.email_connect
+        else:
+            with self.connection_pool.connection() as email_connect:
+                yield email_connect
+
+    def process_new_mail(self) -> bool:
+        # False - папку сейчас обрабатывает другой узел
+        if self.lease is not None and not self.lease.acquire():
+            self.log.info(f"Папку {self.folder} обрабатывает другой узел")
+            return False
+        with self._borrow_connection() as email_connect:
+            self._process_new_mail(email_connect)
+        return True
+
+    def _process_new_mail(self, email_connect: EmailConnection):
+        uidvalidity, last_uid = email_connect.select_folder(self.folder)
+        self.uidvalidity = uidvalidity
+
+        offset_uid, last_uid = self.checkpoint.get_range(email_connect, uidvalidity, last_uid)
+        if offset_uid >= last_uid:
             self.log.info(f'Нет новых писем в папке {self.folder}')
             return
 
-        list_actual_id = range(offset + 1, last_id + 1)
+        self._offsets = OffsetTracker(offset_uid)
+        pipeline = self._build_pipeline()
+        pipeline.start()
+        try:
+            headers = email_connect.iter_headers(offset_uid + 1, last_uid, self.folder,
+                                                 batch_size=self.profile.fetch_batch_size)
+            for batch_last_uid, headers_batch in self._timed_iter(headers, "fetch_headers"):
+                batch_uids = {mail_headers.uid for mail_headers in headers_batch}
+                self._offsets.start(batch_uids)
+                selected = self._select_mails(uidvalidity, headers_batch)
+                if selected:
+                    bodies = email_connect.iter_bodies(selected, self.folder, force_to_image=self.profile.force_to_image,
+                                                       store=self.attachment_store, limits=self.fetch_limits,
+                                                       on_error=self._on_fetch_error)
+                    for uid, _data in self._timed_iter(bodies, "fetch_bodies"):
+                        batch_uids.discard(uid)
+                        # Ждет, если этапы не успевают: в памяти не больше писем, чем вмещают очереди
+                        pipeline.put(MailTask(uid, _data))
+                # Отфильтрованные письма и письма, удаленные с сервера до загрузки тела, не задерживают оффсет
+                self._offsets.finish(batch_uids)
+                self._offsets.fetched_up_to(batch_last_uid)
+                queue_depths = pipeline.get_queue_depths()
+                self.log.debug(f"Очереди конвейера папки {self.folder}: {queue_depths}")
+                for stage_name, depth in queue_depths.items():
+                    self.metrics.set_gauge("pipeline_queue_depth", depth, profile=self.profile.key, stage=stage_name)
 
-        for mail_id in list_actual_id:
-            self.log.info(f"Обработка mail_id {mail_id} из папки {self.folder}")
-            _data = self.email_connect.get_mail_by_id(mail_id, self.folder)
-            mail_data = MailData.get_builder()(raw_mail=_data,
-                                               folder=self.folder,
-                                               mail_id=str(mail_id),
-                                               force_to_image=self.profile.force_to_image,
-                                               replacements=self.profile.replacements
-                                               ).build()
+                if self._pipeline_error is not None or pipeline.error is not None:
+                    break
+                if self.stop_event.is_set():
+                    self.log.info(f"Остановка обработки папки {self.folder} по сигналу")
+                    break
+        finally:
+            pipeline.close()
+            self._offsets.commit(self._write_offset)
+            self.stage_stats = pipeline.get_stage_stats()
+            self.log.info(f"Этапы конвейера папки {self.folder}: {self.stage_stats}")
 
-            self.log.info(f"Тема письма {mail_data.subject}")
+        # Письмо, которое не удалось ни обработать, ни записать в failed_mails, держит оффсет: папка повторится
+        error = self._pipeline_error or pipeline.error
+        if error is not None:
+            raise error
+        self.log.info(f"Статистика фильтров папки {self.folder}: {self.profile.filters.get_stats()}")
 
-            # Исключаем получателей не нас
-            if not re.search(self.profile.receiver_regex_mask, mail_data.receiver):
-                self.log.info(f"Исключено по получателю {mail_data.receiver}")
-                continue
+    def _build_pipeline(self) -> Pipeline:
+        self._pipeline_error = None
+        pipeline = Pipeline(f"pipeline-{self.folder}", on_error=self._on_stage_error)
+        pipeline.add_stage("build", self._stage_build, **self._get_stage_settings("build", 2))
+        pipeline.add_stage("attachments", self._stage_attachments, **self._get_stage_settings("attachments", 2))
+        # Рендер ограничен еще и общим пулом RenderPool, число потоков этапа - сколько писем профиль ждет одновременно
+        pipeline.add_stage("render", self._stage_render, **self._get_stage_settings("render", self.render_pool.workers))
+        pipeline.add_stage("save", self._stage_save, batch_size=self.db_conn.bulk_batch_size,
+                           **self._get_stage_settings("save", 1))
+        return pipeline
 
-            if mail_data.subject is None:
-                self.log.info(f"Исключено из-за отсутствующей темы")
-                continue
+    def _get_stage_settings(self, stage_name: str, default_workers: int) -> dict:
+        settings = Pipeline.get_stage_settings(stage_name, default_workers)
+        if self.stage_workers is not None:
+            settings["workers"] = self.stage_workers
+        return settings
 
-            is_skip = False
-            for filter in self.profile.restricted_subjects_regex:
-                if re.search(filter, mail_data.subject.lower()):
-                    is_skip = True
-            if is_skip:
-                self.log.info(f"Исключено из-за restricted_subjects_regex")
-                continue
+    def _timer(self, step: str):
+        return self.metrics.timer("step_seconds", profile=self.profile.key, step=step)
 
-            if self.mail_id_already_in_db(mail_id):
-                self.log.info(f"Исключено из-за уже наличия в бд")
+    def _timed_iter(self, iterator: Iterator, step: str) -> Iterator:
+        return self.metrics.timed_iter(iterator, "step_seconds", profile=self.profile.key, step=step)
+
+    def _stage_build(self, task: "MailTask") -> "MailTask":
+        with self._timer("build"):
+            task.mail_data = self._get_builder(task.raw_mail, self.uidvalidity, task.uid).build().load()
+        task.raw_mail = None
+        return task
+
+    def _stage_attachments(self, task: "MailTask") -> "MailTask":
+        with self._timer("save_attachment"):
+            MailBuilder.save_attachment(task.mail_data, store=self.attachment_store)
+        # Дальше исходное письмо не нужно, а рендер и запись в БД могут ждать в очередях
+        task.mail_data.raw_data = None
+        return task
+
+    def _stage_render(self, task: "MailTask") -> "MailTask":
+        mail_data = task.mail_data
+        if MailBuilder.is_html(mail_data):
+            try:
+                with self._timer("render"):
+                    tiles = self.render_pool.submit(mail_data.body,
+                                                    name=mail_data.id,
+                                                    max_height=self.profile.max_height_px,
+                                                    max_width=self.profile.max_width_px,
+                                                    encoding=self.profile.image_encoding).result()
+                MailBuilder.apply_image(mail_data, tiles)
+            except Exception as e:
+                mail_data.render_failed = True
+                self.metrics.inc("render_failed_total", profile=self.profile.key)
+                self.log.error(f"Не удалось перевести письмо {mail_data.id} в изображение", exc_info=e)
+        return task
+
+    def _stage_save(self, tasks: List["MailTask"]):
+        rejected = self._save_mails_data([task.mail_data for task in tasks])
+        for task in tasks:
+            # Письмо, которое MongoDB не приняла, не запишется и при повторе: в failed_mails, оффсет не держит
+            if task.mail_data.id in rejected:
+                self._record_failed_mail(self.uidvalidity, task.uid, rejected[task.mail_data.id])
+        self._offsets.finish(task.uid for task in tasks)
+        self._offsets.commit(self._write_offset)
+
+    def _on_stage_error(self, stage_name: str, task: "MailTask", error: Exception):
+        if stage_name == "save":
+            # Письмо не записано: оффсет на нем останавливается, обработка папки прерывается
+            self.log.error(f"Ошибка записи письма uid {task.uid} папки {self.folder} в БД", exc_info=error)
+            self._pipeline_error = error
+            return
+        self._record_failed_mail(self.uidvalidity, task.uid, error)
+        self._offsets.finish([task.uid])
+
+    def _on_fetch_error(self, uid: int, error: Exception):
+        # Письмо больше fetch.max_message_megabytes или его вложение не записалось в хранилище:
+        # письмо записывается в failed_mails и оффсет не задерживает
+        self._record_failed_mail(self.uidvalidity, uid, error)
+
+    def _write_offset(self, uid: int):
+        if self.lease is not None:
+            # Пока узел ждал рендер или MongoDB, его аренда могла истечь и перейти к другому узлу
+            self.lease.ensure()
+        self.checkpoint.save(uid, self.uidvalidity)
+
+    def _select_mails(self, uidvalidity: int, headers_batch: List["MailHeaders"]) -> List["MailHeaders"]:
+        # Фильтры по заголовкам и проверка наличия в БД: тело забирается только у оставшихся писем
+        self.metrics.inc("mails_fetched_total", len(headers_batch), profile=self.profile.key)
+        with self._timer("filter"):
+            return self._filter_headers(uidvalidity, headers_batch)
+
+    def _filter_headers(self, uidvalidity: int, headers_batch: List["MailHeaders"]) -> List["MailHeaders"]:
+        selected = {}
+        for mail_headers in headers_batch:
+            self.log.info(f"Обработка uid {mail_headers.uid} из папки {self.folder}")
+            try:
+                # build() ленивый: заголовки декодируются при обращении к полям в _is_filtered
+                preview = self._get_builder(mail_headers.headers, uidvalidity, mail_headers.uid).build(with_body=False)
+                if self._is_filtered(preview):
+                    continue
+            except Exception as e:
+                self._record_failed_mail(uidvalidity, mail_headers.uid, e)
                 continue
+            selected[preview.id] = mail_headers
 
-            MailBuilder.save_attachment(mail_data, store_path=self.attachments_path)
-            if MailBuilder.is_html(mail_data):
-                MailBuilder.html_message_to_image(mail_data, store_path=self.attachments_path,
-                                                  max_height=self.profile.max_height_px,
-                                                  max_width=self.profile.max_width_px)
+        # Одна выборка по уникальному индексу на пачку вместо запроса на каждое письмо
+        for mail_id in self.db_conn.get_existing_mail_ids(selected.keys()):
+            self.log.info(f"Исключено из-за уже наличия в бд {mail_id}")
+            self.profile.filters.count(FilterEngine.ALREADY_IN_DB_RULE)
+            del selected[mail_id]
+        return list(selected.values())
 
-            mails_conn = self.db_conn.table("mails")
-            mail_db_data = mail_data.to_dict()
-            mail_db_data.update(self.profile.ext_fields)
-            mails_conn.insert_one(mail_db_data)
-            self.log.debug(f"Inserted in 'mails' table: {mail_db_data}")
+    def wait_for_new_mail(self, use_idle: bool = True) -> bool:
+        # IMAP IDLE, если сервер его поддерживает, иначе ожидание schedule.poll_interval_sec до следующего опроса.
+        # Поддержка IDLE известна только после подключения, поэтому таймаут выбирается здесь
+        if use_idle and self.email_connect is not None and self.email_connect.supports_idle():
+            return self.email_connect.idle(IDLE_MAX_SECONDS, stop_event=self.stop_event)
+        self.stop_event.wait(self.profile.poll_interval_sec)
+        return False
 
-        self.db_conn.table("offset_folder").delete_many(filter={'folder': self.folder})
-        self.db_conn.table("offset_folder").insert_one({'folder': self.folder,
-                                                        'offset': last_id
-                                                        })
-        self.log.info(f"Записи офсета обновлены для папки {self.folder}")
-        self.email_connect.close()
+    def close(self, broken: bool = False):
+        if self._owns_render_pool:
+            self.render_pool.shutdown()
+        if self.lease is not None:
+            try:
+                self.lease.release()
+            except Exception as e:
+                # Не освобожденная аренда истечет сама
+                self.log.warning(f"Не удалось освободить аренду папки {self.folder}", exc_info=e)
+        if self.email_connect is not None and self.connection_pool is not None:
+            self.connection_pool.release(self.email_connect, broken=broken)
+            self.email_connect = None
+        elif self.email_connect is not None:
+            try:
+                if self.email_connect.state == "SELECTED":
+                    self.email_connect.close()
+                self.email_connect.logout()
+            except Exception as e:
+                self.log.warning(f"Ошибка при закрытии соединения с почтой для папки {self.folder}", exc_info=e)
+            self.email_connect = None
 
-    def mail_id_already_in_db(self, mail_id) -> bool:
-        mail_id = f"{self.folder}{mail_id}"
-        db_data = self.db_conn.table("mails").count_documents({"mail_id": mail_id})
-        return db_data > 0
+    def _get_builder(self, raw_mail: Message, uidvalidity: int, uid: int) -> MailBuilder:
+        return MailData.get_builder()(raw_mail=raw_mail,
+                                      folder=self.folder,
+                                      mail_id=self.profile.get_mail_id(uidvalidity, uid),
+                                      force_to_image=self.profile.force_to_image,
+                                      replacements=self.profile.replacements,
+                                      normalizer=self.profile.body_normalizer
+                                      )
 
+    def _is_filtered(self, mail_data: MailData) -> bool:
+        self.log.info(f"Тема письма {mail_data.subject}")
 
+        rule = self.profile.filters.check(mail_data.receiver, mail_data.subject)
+        if rule is not None:
+            self.log.info(f"Исключено по правилу {rule}, получатель {mail_data.receiver}")
+            return True
+        return False
+
+    def _save_mails_data(self, mails: List[MailData]) -> Dict[str, Exception]:
+        mails_db_data = []
+        for mail_data in mails:
+            mail_db_data = mail_data.to_dict()
+            mail_db_data.update(self.profile.ext_fields)
+            mails_db_data.append(mail_db_data)
 
+        with self._timer("db_write"):
+            inserted, already_stored, rejected = self.db_conn.save_mails(mails_db_data)
+        self.metrics.inc("mails_persisted_total", len(inserted), profile=self.profile.key)
+        self.metrics.inc("mails_already_stored_total", len(already_stored), profile=self.profile.key)
+        for mail_id in already_stored:
+            self.log.info(f"Письмо {mail_id} уже сохранено в БД")
+        self.log.debug(f"Inserted in 'mails' table: {inserted}")
+        return rejected
 
+    def _record_failed_mail(self, uidvalidity: int, uid: int, error: Exception):
+        mail_id = self.profile.get_mail_id(uidvalidity, uid)
+        self.log.error(f"Ошибка обработки письма {mail_id}, письмо пропущено", exc_info=error)
+        self.metrics.inc("mails_failed_total", profile=self.profile.key)
+        self.db_conn.record_failed_mail(self.profile.key, mail_id, uid, error)
 
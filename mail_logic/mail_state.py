@@ -0,0 +1,59 @@
+import json
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from common.config_controller import Config
+from .profile import ConfigProfile
+
+_UNSAFE_FILENAME_CHARS_RE = re.compile(r"[^\w.@-]")
+
+
+class MailboxState:
+    # UIDVALIDITY и UIDNEXT папок ящика после последней успешной выгрузки, в локальном файле.
+    # Если STATUS папки с тех пор не изменился, новых писем нет: режим run не подключается к MongoDB,
+    # не запускает пул рендера и не делает SELECT. Один файл на ящик - в режиме run у каждого ящика свой процесс
+    def __init__(self, path: str):
+        self.path = path
+        self._folders: Dict[str, List[int]] = self._load()
+        self._lock = threading.Lock()
+        self.log = Config.get_common_logger()
+
+    @classmethod
+    def from_config(cls, profiles: List[ConfigProfile]) -> Optional["MailboxState"]:
+        conf = Config().data.get("precheck") or {}
+        if not conf.get("enabled", True):
+            return None
+        path = conf.get("path") or os.path.join(Config().attachment_path, ".mail_state")
+        account = _UNSAFE_FILENAME_CHARS_RE.sub("_", f"{profiles[0].login}@{profiles[0].imap_host}")
+        return cls(os.path.join(path, f"{account}.json"))
+
+    def _load(self) -> Dict[str, List[int]]:
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def is_unchanged(self, profile: ConfigProfile, status: Tuple[int, int]) -> bool:
+        with self._lock:
+            return self._folders.get(profile.key) == list(status)
+
+    def remember(self, profile: ConfigProfile, status: Tuple[int, int]):
+        # status - результат STATUS до обработки: письма, пришедшие во время выгрузки, увидит следующий запуск
+        with self._lock:
+            self._folders[profile.key] = list(status)
+
+    def save(self):
+        with self._lock:
+            content = json.dumps(self._folders, ensure_ascii=False)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                file.write(content)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            # Без файла следующий запуск просто выполнит полную проверку папок
+            self.log.warning(f"Не удалось сохранить состояние папок в {self.path}", exc_info=e)
@@ -0,0 +1,42 @@
+import re
+from typing import Iterator, Optional, Pattern
+
+_CID_RE = re.compile(r'\[cid:.*\]')
+
+
+def _iter_lines(text: str) -> Iterator[str]:
+    # Строки по одной, без списка всех строк письма. Само тело к этому моменту уже раскодировано целиком
+    # (CharsetDecoder проверяет кодировку по всему содержимому), поэтому пик памяти это не снижает -
+    # экономится разбиение и копирование строк после места, где письмо обрезается
+    start = 0
+    while start < len(text):
+        end = text.find('\n', start)
+        if end == -1:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
+
+class BodyNormalizer:
+    # Один проход по строкам тела: ссылки на вложения cid заменяются на [Вложение N],
+    # письмо обрезается на заголовке пересылки/ответа или на строке regex_last_string_mask (она остается)
+    def __init__(self, last_row_regex: Optional[Pattern] = None):
+        self.last_row_regex = last_row_regex
+
+    def normalize(self, body: str) -> str:
+        new_list = []
+        count = 1
+        for row in _iter_lines(body):
+            row = row.replace('\r', '')
+            is_last_row = self.last_row_regex is not None and self.last_row_regex.search(row) is not None
+            if _CID_RE.search(row):
+                row = '[Вложение ' + str(count) + ']'
+                count += 1
+            if row.find('*From:*') != -1 or row.find('From: ') != -1:
+                break
+            if row != '':
+                new_list.append(row)
+            if is_last_row:
+                break
+        return '\n'.join(new_list)
@@ -0,0 +1,170 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from common.config_controller import Config
+
+_STOP = object()
+
+
+class Stage:
+    # batch_size > 1: обработчик получает список элементов, которые уже лежат в очереди (например, для bulk_write)
+    def __init__(self, name: str, handler: Callable, workers: int = 1, queue_size: int = 100, batch_size: int = 1):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads: List[threading.Thread] = []
+        self.next_stage: Optional["Stage"] = None
+        self.items = 0
+        self.busy_sec = 0.0
+        self._stats_lock = threading.Lock()
+
+    def add_stats(self, items: int, busy_sec: float):
+        with self._stats_lock:
+            self.items += items
+            self.busy_sec += busy_sec
+
+
+class Pipeline:
+    # Этапы обработки, соединенные ограниченными очередями. Когда очередь следующего этапа заполнена,
+    # предыдущий этап ждет, поэтому отстающий рендер тормозит чтение почты, а не копит письма в памяти
+    def __init__(self, name: str, on_error: Callable[[str, Any, Exception], None]):
+        self.name = name
+        self.on_error = on_error
+        self.stages: List[Stage] = []
+        # Первая ошибка самого on_error: обработку надо прервать, но потоки этапов продолжают разбирать очереди
+        self.error: Optional[Exception] = None
+        self.log = Config.get_common_logger()
+
+    @staticmethod
+    def get_stage_settings(stage_name: str, default_workers: int = 1) -> dict:
+        pipeline_conf = Config().data.get("pipeline") or {}
+        stage_conf = (pipeline_conf.get("stages") or {}).get(stage_name) or {}
+        return {"workers": stage_conf.get("workers", default_workers),
+                "queue_size": stage_conf.get("queue_size", pipeline_conf.get("queue_size", 100))}
+
+    def add_stage(self, name: str, handler: Callable, workers: int = 1, queue_size: int = 100,
+                  batch_size: int = 1) -> "Pipeline":
+        stage = Stage(name, handler, workers=workers, queue_size=queue_size, batch_size=batch_size)
+        if self.stages:
+            self.stages[-1].next_stage = stage
+        self.stages.append(stage)
+        return self
+
+    def start(self):
+        for stage in self.stages:
+            for index in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(stage,), daemon=True,
+                                          name=f"{self.name}-{stage.name}-{index}")
+                stage.threads.append(thread)
+                thread.start()
+
+    def put(self, item):
+        # Блокируется, пока в очереди первого этапа нет места
+        self.stages[0].queue.put(item)
+
+    def close(self):
+        # Этапы останавливаются по порядку, поэтому все, что уже попало в очереди, будет обработано
+        for stage in self.stages:
+            for _ in stage.threads:
+                stage.queue.put(_STOP)
+            for thread in stage.threads:
+                thread.join()
+
+    def get_queue_depths(self) -> Dict[str, int]:
+        return {stage.name: stage.queue.qsize() for stage in self.stages}
+
+    def get_stage_stats(self) -> Dict[str, dict]:
+        # busy_sec - суммарное время обработчика во всех потоках этапа
+        return {stage.name: {"items": stage.items, "busy_sec": round(stage.busy_sec, 3)} for stage in self.stages}
+
+    def _work(self, stage: Stage):
+        while True:
+            item = stage.queue.get()
+            if item is _STOP:
+                return
+            items = [item]
+            stop_after = False
+            while len(items) < stage.batch_size:
+                try:
+                    item = stage.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop_after = True
+                    break
+                items.append(item)
+
+            self._handle(stage, items)
+            if stop_after:
+                return
+
+    def _handle(self, stage: Stage, items: List):
+        started = time.perf_counter()
+        try:
+            if stage.batch_size > 1:
+                results = stage.handler(items) or []
+            else:
+                results = [stage.handler(items[0])]
+        except Exception as e:
+            for item in items:
+                self._report_error(stage, item, e)
+            return
+        finally:
+            stage.add_stats(len(items), time.perf_counter() - started)
+
+        if stage.next_stage is not None:
+            for result in results:
+                if result is not None:
+                    stage.next_stage.queue.put(result)
+
+    def _report_error(self, stage: Stage, item, error: Exception):
+        # Если поток этапа завершится, put() предыдущего этапа и close() будут ждать места в очереди вечно
+        try:
+            self.on_error(stage.name, item, error)
+        except Exception as e:
+            self.log.error(f"Ошибка обработки сбоя этапа {stage.name} конвейера {self.name}", exc_info=e)
+            if self.error is None:
+                self.error = e
+
+
+class OffsetTracker:
+    # Письма завершаются не по порядку, а оффсет можно сдвинуть только до первого незавершенного UID
+    def __init__(self, offset_uid: int):
+        self.committed_uid = offset_uid
+        self._fetched_uid = offset_uid
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+
+    def start(self, uids: Iterable[int]):
+        with self._lock:
+            self._pending.update(uids)
+
+    def finish(self, uids: Iterable[int]):
+        with self._lock:
+            self._pending.difference_update(uids)
+
+    def fetched_up_to(self, uid: int):
+        # Все письма до uid включительно уже переданы в start, пропуски между UID считаются обработанными
+        with self._lock:
+            self._fetched_uid = max(self._fetched_uid, uid)
+
+    def committable(self) -> int:
+        with self._lock:
+            if self._pending:
+                return min(self._pending) - 1
+            return self._fetched_uid
+
+    def commit(self, write: Callable[[int], None]) -> Optional[int]:
+        # write вызывается под блокировкой, чтобы оффсет в БД никогда не сдвигался назад
+        with self._commit_lock:
+            uid = self.committable()
+            if uid <= self.committed_uid:
+                return None
+            write(uid)
+            self.committed_uid = uid
+            return uid
@@ -1,5 +1,9 @@
 from typing import List
 
+from .filters import FilterEngine, compile_regex
+from .image_encoding import ImageEncoding
+from .normalizer import BodyNormalizer
+
 
 class ConfigProfile:
     def __init__(self, **kwargs):
@@ -7,14 +11,42 @@ class ConfigProfile:
         self.passw = kwargs["source"]["password"]
         self.folder = kwargs["source"]["folder"]
         self.imap_host = kwargs["source"]["imap_host"]
+        self.imap_port = kwargs["source"].get("port", 993)
+        self.use_ssl = kwargs["source"].get("ssl", True)
+        # Ключ оффсета профиля в БД: одна и та же папка может читаться из разных ящиков
+        self.key = f"{self.login}@{self.imap_host}/{self.folder}"
+        self.fetch_batch_size = kwargs["source"].get("fetch_batch_size", 100)
+        # Максимум одновременных IMAP-сессий на ящик (imap_host + login), общих для всех его профилей
+        self.max_connections = kwargs["source"].get("max_connections", 2)
+
+        # Расписание для режима демона
+        schedule = kwargs.get("schedule") or {}
+        self.use_idle = schedule.get("use_idle", True)
+        self.poll_interval_sec = schedule.get("poll_interval_sec", 60)
+        self.min_backoff_sec = schedule.get("min_backoff_sec", 5)
+        self.max_backoff_sec = schedule.get("max_backoff_sec", 600)
 
         image = kwargs.get("image", {})
         self.force_to_image = image.get("force_to_image", False)
         self.max_width_px = image.get("max_width_px", 800)
         self.max_height_px = image.get("max_height_px", 1400)
+        self.image_encoding = ImageEncoding.from_config(image)
 
-        self.last_row_of_letter = kwargs.get("regex_last_string_mask", "")
-        self.replacements: List[dict] = kwargs.get("replacements", [])
+        self.last_row_of_letter = kwargs.get("regex_last_string_mask") or ""
+        self.body_normalizer = BodyNormalizer(compile_regex(self.last_row_of_letter, "regex_last_string_mask", self.key)
+                                              if self.last_row_of_letter else None)
+        # Шаблоны замен компилируются и проверяются один раз при запуске
+        self.replacements: List[dict] = [{"pattern": compile_regex(replacement["pattern"], "replacements", self.key),
+                                          "substr": replacement["substr"]}
+                                         for replacement in kwargs.get("replacements") or []]
         self.ext_fields = kwargs.get("extra_fields", {})
         self.receiver_regex_mask = kwargs["filters"].get("receiver_regex_mask", ".*")
         self.restricted_subjects_regex = kwargs["filters"]["restricted_subjects_regex"]
+        self.filters = FilterEngine(self.receiver_regex_mask, self.restricted_subjects_regex, self.key)
+
+    def get_mail_id(self, uidvalidity: int, uid: int) -> str:
+        # id письма в mails и failed_mails: ящик входит в id, у разных ящиков совпадают имена папок и UIDVALIDITY
+        return f"{self.get_mail_id_prefix(uidvalidity)}{uid}"
+
+    def get_mail_id_prefix(self, uidvalidity: int) -> str:
+        return f"{self.key}:{uidvalidity}:"
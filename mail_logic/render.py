@@ -0,0 +1,161 @@
+import hashlib
+import io
+import os
+import re
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+from sys import platform
+from typing import List, Optional
+
+from common.config_controller import Config
+from common.metrics import Metrics
+from .image_encoding import ImageEncoding, get_content_height
+from .render_cache import RenderCache, link_or_copy
+
+_UNSAFE_FILENAME_CHARS_RE = re.compile(r"[^\w.-]")
+
+
+class HtmlRenderer:
+    # imgkit и PIL импортируются при первом рендере: профилям без html картинок они не нужны
+    _imgkit_config = None
+
+    def __init__(self, store_path: str, timeout: Optional[float] = None, cache: Optional[RenderCache] = None):
+        self.store_path = store_path
+        self.timeout = timeout
+        self.cache = cache
+        self.log = Config.get_common_logger()
+
+    @classmethod
+    def _get_imgkit_config(cls):
+        # imgkit.config() ищет wkhtmltoimage через which, делаем это один раз
+        if cls._imgkit_config is None:
+            import imgkit
+            if platform == "win32":
+                cls._imgkit_config = imgkit.config(wkhtmltoimage=r'C:\Program Files\wkhtmltopdf\bin\wkhtmltoimage.exe')
+            else:
+                cls._imgkit_config = imgkit.config()
+        return cls._imgkit_config
+
+    def _get_paths(self, name: str, amount: int, extension: str) -> List[str]:
+        # Имена картинок определяются id письма, а не случайным словом. Если в id были недопустимые символы,
+        # добавляется хэш исходного id, чтобы разные письма не получили одно имя после замены символов
+        safe_name = _UNSAFE_FILENAME_CHARS_RE.sub("_", name)
+        if safe_name != name:
+            safe_name = f"{safe_name}_{hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]}"
+        base_path = os.path.join(self.store_path, safe_name)
+        if amount == 1:
+            return [f"{base_path}.{extension}"]
+        return [f"{base_path}_{index}.{extension}" for index in range(amount)]
+
+    @staticmethod
+    def _describe_tile(path: str, encoding: ImageEncoding, size: Optional[tuple] = None) -> dict:
+        # Размеры картинок пишутся в документ письма, чтобы их не приходилось открывать для раскладки
+        if size is None:
+            from PIL import Image
+            with Image.open(path) as image:
+                size = image.size
+        return {"path": path,
+                "format": encoding.format,
+                "width": size[0],
+                "height": size[1],
+                "size": os.path.getsize(path)}
+
+    @staticmethod
+    def _write_file(path: str, data: bytes):
+        # Пишем во временный файл и переименовываем, чтобы при падении не оставалось недописанных картинок
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp_path, path)
+
+    def render(self, html: str, name: str, max_height: int = 1200, max_width: int = 600,
+               encoding: ImageEncoding = None) -> List[dict]:
+        # Возвращает картинки письма (путь, формат, размеры): одна картинка или нарезка по max_height
+        encoding = encoding or ImageEncoding()
+        metrics = Metrics()
+        if self.cache is None:
+            with metrics.timer("render_seconds", cache="disabled"):
+                return self._render(html, name, max_height, max_width, encoding)
+
+        # Одно и то же письмо в разных форматах - разные записи кэша
+        key = self.cache.make_key(html, max_width, max_height, encoding)
+        cached_paths = self.cache.get(key)
+        if cached_paths:
+            metrics.inc("render_cache_hits_total")
+            self.log.debug(f"Картинка письма взята из кэша {key}")
+            paths = self._get_paths(name, len(cached_paths), encoding.extension)
+            for cached_path, path in zip(cached_paths, paths):
+                if os.path.exists(path):
+                    os.remove(path)
+                link_or_copy(cached_path, path)
+            return [self._describe_tile(path, encoding) for path in paths]
+
+        with metrics.timer("render_seconds", cache="miss"):
+            tiles = self._render(html, name, max_height, max_width, encoding)
+        self.cache.put(key, [tile["path"] for tile in tiles])
+        return tiles
+
+    def _render(self, html: str, name: str, max_height: int, max_width: int, encoding: ImageEncoding) -> List[dict]:
+        text = re.sub('<img[^>]*>', '', html)
+        text = re.sub('<img>[^>]*</img>', '', text)
+        text = text.replace('src="cid:', 'src="')
+        text = f"<html><style> html{{width: {max_width}px !important;}}</style>" + text + "</html>"
+
+        self.log.debug(f"HTML to image: {text}")
+        options = {
+            'width': max_width,
+            'encoding': 'UTF-8',
+            'format': 'png',
+            '--disable-smart-width': ""
+        }
+        # Картинка читается из stdout wkhtmltoimage, на диск пишутся только итоговые файлы
+        import imgkit
+        from PIL import Image
+        command = imgkit.IMGKit(text, "string", options=options, config=self._get_imgkit_config()).command("-")
+        # subprocess.run с timeout убивает зависший wkhtmltoimage
+        result = subprocess.run(command, input=text.encode("utf-8"), stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, timeout=self.timeout)
+        if result.returncode != 0 or not result.stdout:
+            stderr = (result.stderr or b"").decode("utf-8", errors="replace")
+            raise IOError(f"wkhtmltoimage exited with code {result.returncode}. error:\n{stderr}")
+
+        with Image.open(io.BytesIO(result.stdout)) as input_image:
+            image = input_image.convert("RGB")
+        image_width, image_height = image.size
+        # Пустой низ страницы отрезается, поэтому пустых картинок в конце нарезки нет
+        content_height = get_content_height(image) or min(image_height, max_height)
+
+        # Обрезание по высоте слишком длинных писем
+        tops = range(0, content_height, max_height)
+        paths = self._get_paths(name, len(tops), encoding.extension)
+        tiles = []
+        for path, upper in zip(paths, tops):
+            tile = image.crop((0, upper, image_width, min(upper + max_height, content_height)))
+            self._write_file(path, encoding.encode(tile))
+            tiles.append(self._describe_tile(path, encoding, tile.size))
+        return tiles
+
+
+class RenderPool:
+    # Отдельный пул для html -> картинка, чтобы медленный рендер не останавливал чтение почты и запись в БД
+    def __init__(self, store_path: str, workers: Optional[int] = None, timeout: Optional[float] = None,
+                 cache: Optional[RenderCache] = None):
+        self.renderer = HtmlRenderer(store_path, timeout=timeout, cache=cache)
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="render")
+
+    @classmethod
+    def from_config(cls, store_path: str) -> "RenderPool":
+        render_conf = Config().data.get("render") or {}
+        return cls(store_path, workers=render_conf.get("workers"), timeout=render_conf.get("timeout_sec", 60),
+                   cache=RenderCache.from_config(store_path))
+
+    def submit(self, html: str, name: str, max_height: int, max_width: int,
+               encoding: ImageEncoding = None) -> Future:
+        # Сжатие картинок тоже идет в потоке рендера
+        return self.executor.submit(self.renderer.render, html, name, max_height, max_width, encoding)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        if self.renderer.cache is not None:
+            self.renderer.log.info(f"Кэш рендера: {self.renderer.cache.stats()}")
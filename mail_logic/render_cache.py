@@ -0,0 +1,132 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from typing import List, Optional
+
+from common.config_controller import Config
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def link_or_copy(src: str, dst: str):
+    # Жесткая ссылка не занимает место, но не работает между разными файловыми системами
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class RenderCache:
+    # Кэш готовых картинок по хэшу html, размеров и формата: одинаковые письма не рендерятся повторно.
+    # Запись кэша - папка <path>/<key[:2]>/<key> с картинками 0.png, 1.png... (расширение по формату);
+    # mtime папки - время последнего обращения
+    EVICT_EVERY_PUTS = 50
+
+    def __init__(self, path: str, max_bytes: int, max_age_sec: float):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_sec = max_age_sec
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self.log = Config.get_common_logger()
+        os.makedirs(self.path, exist_ok=True)
+        self.evict()
+
+    @classmethod
+    def from_config(cls, store_path: str) -> Optional["RenderCache"]:
+        cache_conf = (Config().data.get("render") or {}).get("cache") or {}
+        if not cache_conf.get("enabled", True):
+            return None
+        return cls(path=cache_conf.get("path") or os.path.join(store_path, ".render_cache"),
+                   max_bytes=cache_conf.get("max_megabytes", 1024) * 1024 * 1024,
+                   max_age_sec=cache_conf.get("max_age_days", 30) * 24 * 60 * 60)
+
+    @staticmethod
+    def make_key(html: str, *params) -> str:
+        normalized = _WHITESPACE_RE.sub(" ", html).strip()
+        key = hashlib.sha256(repr(params).encode("utf-8"))
+        key.update(normalized.encode("utf-8", errors="surrogatepass"))
+        return key.hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key)
+
+    @staticmethod
+    def _entry_files(entry_path: str) -> List[str]:
+        names = [name for name in os.listdir(entry_path) if not name.startswith(".")]
+        names.sort(key=lambda name: int(name.split(".")[0]))
+        return [os.path.join(entry_path, name) for name in names]
+
+    def get(self, key: str) -> Optional[List[str]]:
+        entry_path = self._entry_path(key)
+        try:
+            files = self._entry_files(entry_path)
+            os.utime(entry_path)
+        except (OSError, ValueError):
+            files = []
+
+        with self._lock:
+            if files:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return files or None
+
+    def put(self, key: str, image_paths: List[str]):
+        entry_path = self._entry_path(key)
+        if os.path.isdir(entry_path):
+            return
+
+        tmp_path = os.path.join(self.path, f".tmp_{uuid.uuid4().hex}")
+        os.makedirs(tmp_path)
+        try:
+            for index, image_path in enumerate(image_paths):
+                link_or_copy(image_path, os.path.join(tmp_path, f"{index}{os.path.splitext(image_path)[1]}"))
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+            os.rename(tmp_path, entry_path)
+        except OSError:
+            # Ту же картинку параллельно положил другой поток или процесс
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+        with self._lock:
+            self._puts += 1
+            need_evict = self._puts % self.EVICT_EVERY_PUTS == 0
+        if need_evict:
+            self.evict()
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for shard in os.scandir(self.path):
+            if not shard.is_dir() or shard.name.startswith("."):
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    size = sum(file.stat().st_size for file in os.scandir(entry.path))
+                    entries.append((entry.stat().st_mtime, size, entry.path))
+                except OSError:
+                    continue
+
+        entries.sort()
+        total_size = sum(size for _, size, _ in entries)
+        evicted = 0
+        for mtime, size, entry_path in entries:
+            if now - mtime <= self.max_age_sec and total_size <= self.max_bytes:
+                break
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_size -= size
+            evicted += 1
+
+        with self._lock:
+            self.evictions += evicted
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from common.config_controller import Config
+from common.metrics import Metrics
+from database.database import MongoDatabase
+from .connection_pool import ImapConnectionPool
+from .lease import LeaseManager
+from .mail_logic import MailFacade
+from .mail_state import MailboxState
+from .profile import ConfigProfile
+from .render import RenderPool
+
+
+def _process_profile(profile: ConfigProfile, db_conn: MongoDatabase, render_pool: RenderPool,
+                     connection_pool: ImapConnectionPool, leases: Optional[LeaseManager]) -> bool:
+    # True - все письма папки на момент запуска выгружены этим процессом
+    facade = MailFacade(profile, db_conn=db_conn, render_pool=render_pool, connection_pool=connection_pool,
+                        leases=leases)
+    try:
+        return facade.process_new_mail()
+    except Exception as e:
+        Config.get_common_logger().error(f"Ошибка обработки папки {profile.folder}", exc_info=e)
+        return False
+    finally:
+        facade.close()
+
+
+def _check_profiles(profiles: List[ConfigProfile], connection_pool: ImapConnectionPool,
+                    state: Optional[MailboxState]) -> List[Tuple[ConfigProfile, Optional[Tuple[int, int]]]]:
+    # Дешевая проверка перед обработкой: один STATUS на папку в одной сессии
+    if state is None:
+        return [(profile, None) for profile in profiles]
+    log = Config.get_common_logger()
+    try:
+        with connection_pool.connection() as email_connect:
+            statuses = [email_connect.get_status(profile.folder) for profile in profiles]
+    except Exception as e:
+        log.warning("Не удалось проверить папки командой STATUS, обрабатываются все папки", exc_info=e)
+        return [(profile, None) for profile in profiles]
+
+    changed = []
+    for profile, status in zip(profiles, statuses):
+        if state.is_unchanged(profile, status):
+            log.info(f"Нет новых писем в папке {profile.folder}")
+        else:
+            changed.append((profile, status))
+    return changed
+
+
+def run_account(profiles: List[ConfigProfile]):
+    # Однократная обработка всех профилей одного ящика в одном процессе:
+    # общий пул IMAP-сессий, один MongoClient и один пул рендера
+    metrics = Metrics()
+    metrics.start()
+    connection_pool = ImapConnectionPool.for_profiles(profiles)
+    state = MailboxState.from_config(profiles)
+    try:
+        changed = _check_profiles(profiles, connection_pool, state)
+        if changed:
+            _process_profiles(changed, connection_pool, state)
+    finally:
+        connection_pool.close()
+        metrics.close()
+
+
+def _process_profiles(profiles: List[Tuple[ConfigProfile, Optional[Tuple[int, int]]]],
+                      connection_pool: ImapConnectionPool, state: Optional[MailboxState]):
+    db_conn = MongoDatabase()
+    leases = LeaseManager.from_config(db_conn)
+    render_pool = RenderPool.from_config(Config().attachment_path)
+    try:
+        with ThreadPoolExecutor(max_workers=connection_pool.max_size, thread_name_prefix="profile") as executor:
+            futures = [(profile, status, executor.submit(_process_profile, profile, db_conn, render_pool,
+                                                         connection_pool, leases))
+                       for profile, status in profiles]
+        if state is not None:
+            for profile, status, future in futures:
+                if status is not None and future.result():
+                    state.remember(profile, status)
+            state.save()
+    finally:
+        render_pool.shutdown()
+        if leases is not None:
+            leases.close()
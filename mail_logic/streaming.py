@@ -0,0 +1,85 @@
+import functools
+from dataclasses import dataclass
+from email.feedparser import BytesFeedParser
+from email.message import Message
+from email.policy import compat32
+from typing import Iterable, Optional
+
+from common.config_controller import Config
+from .attachment_store import AttachmentStore, get_attachment_filename
+
+MB = 1024 * 1024
+
+
+class MessageTooLarge(Exception):
+    pass
+
+
+@dataclass
+class FetchLimits:
+    # chunk_size - размер одного запроса BODY.PEEK[...]<offset.length>, вложения больше него скачиваются частями.
+    # max_message_size - сколько одного письма (тело и мелкие вложения) может находиться в памяти
+    chunk_size: int = 4 * MB
+    max_message_size: int = 64 * MB
+
+    @classmethod
+    def from_config(cls) -> "FetchLimits":
+        conf = Config().data.get("fetch") or {}
+        return cls(chunk_size=int(conf.get("chunk_megabytes", 4) * MB),
+                   max_message_size=int(conf.get("max_message_megabytes", 64) * MB))
+
+
+class _Budget:
+    # size - части письма, оставшиеся в памяти после разбора. pending - байты, переданные парсеру после последней
+    # разобранной части: BytesFeedParser копит строки части целиком, даже если потом она уйдет в хранилище
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.pending = 0
+
+    def feed(self, size: int):
+        self.pending += size
+        self._check()
+
+    def add(self, size: int):
+        self.pending = 0
+        self.size += size
+        self._check()
+
+    def _check(self):
+        if self.size + self.pending > self.max_size:
+            raise MessageTooLarge(f"Письмо занимает в памяти больше {self.max_size // MB} МБ")
+
+
+class _SpoolingMessage(Message):
+    # Часть письма для BytesFeedParser: вложение записывается в хранилище, как только парсер дочитал часть,
+    # в дереве письма остается только ссылка stored_ref на файл
+    def __init__(self, store: Optional[AttachmentStore], budget: _Budget, policy=compat32):
+        super().__init__(policy)
+        self._store = store
+        self._budget = budget
+
+    def set_payload(self, payload, charset=None):
+        filename = get_attachment_filename(self) if self._store is not None and isinstance(payload, str) else None
+        if filename is not None:
+            super().set_payload(payload, charset)
+            try:
+                self.stored_ref = self._store.save_part(self, filename)
+                payload = ""
+            except Exception as e:
+                # Не сохранилось - часть останется в памяти, save_attachment попробует еще раз
+                Config.get_common_logger().warning(f"Не удалось сохранить вложение {filename}", exc_info=e)
+        if isinstance(payload, (str, bytes)):
+            self._budget.add(len(payload))
+        super().set_payload(payload, charset)
+
+
+def parse_chunks(chunks: Iterable[bytes], store: Optional[AttachmentStore], max_message_size: int) -> Message:
+    # Письмо разбирается по мере получения, в памяти одновременно не больше одной части письма.
+    # Часть, которая сама больше max_message_size, не поместится в память и при записи в хранилище: MessageTooLarge
+    budget = _Budget(max_message_size)
+    parser = BytesFeedParser(_factory=functools.partial(_SpoolingMessage, store, budget))
+    for chunk in chunks:
+        budget.feed(len(chunk))
+        parser.feed(chunk)
+    return parser.close()
@@ -1,23 +1,75 @@
+import argparse
+import datetime
 import multiprocessing
-import time
+import sys
 from multiprocessing import freeze_support
 
 from common.config_controller import Config
-from mail_logic.mail_logic import MailFacade
+from common.metrics import Metrics
+from mail_logic.async_engine import AsyncEngine
+from mail_logic.backfill import Backfill
+from mail_logic.connection_pool import ImapConnectionPool
+from mail_logic.daemon import Daemon
 from mail_logic.profile import ConfigProfile
+from mail_logic.runner import run_account
 
 if '__main__' == __name__:
+    parser = argparse.ArgumentParser(description="Выгрузка писем из почты в MongoDB")
+    parser.add_argument("mode", nargs="?", choices=["run", "daemon", "async", "backfill"], default="run",
+                        help="run - однократная обработка всех профилей, daemon - постоянная работа с IMAP IDLE, "
+                             "async - все профили в одном процессе на asyncio, "
+                             "backfill - историческая выгрузка одного профиля")
+    parser.add_argument("--loop", action="store_true",
+                        help="для режима async: опрашивать папки постоянно, а не один раз")
+    backfill_args = parser.add_argument_group("backfill")
+    backfill_args.add_argument("--profile", help="папка профиля или ключ login@imap_host/folder")
+    backfill_args.add_argument("--since", type=datetime.date.fromisoformat,
+                               help="дата получения письма, с которой начать (YYYY-MM-DD, включительно)")
+    backfill_args.add_argument("--before", type=datetime.date.fromisoformat,
+                               help="дата получения письма, до которой выгружать (YYYY-MM-DD, не включительно)")
+    backfill_args.add_argument("--uid-from", type=int, help="первый UID диапазона")
+    backfill_args.add_argument("--uid-to", type=int, help="последний UID диапазона, включительно")
+    backfill_args.add_argument("--shard-size", type=int, help="писем в шарде, по умолчанию backfill.shard_size")
+    backfill_args.add_argument("--workers", type=int, help="процессов, по умолчанию backfill.workers")
+    args = parser.parse_args()
+    if args.mode == "backfill" and not args.profile:
+        parser.error("для режима backfill нужен --profile")
+
     conf = Config()
     log = conf.get_common_logger()
     log.info("Start email module")
 
-    freeze_support()
-    list_proc = []
-    for p_data in conf.profiles:
-        list_proc.append(multiprocessing.Process(target=MailFacade, args=(ConfigProfile(**p_data),)))
+    if args.mode in ("daemon", "async"):
+        metrics = Metrics()
+        metrics.start()
+        try:
+            if args.mode == "daemon":
+                Daemon([ConfigProfile(**p_data) for p_data in conf.profiles]).run()
+            else:
+                AsyncEngine([ConfigProfile(**p_data) for p_data in conf.profiles], run_once=not args.loop).run()
+        finally:
+            metrics.close()
+    elif args.mode == "backfill":
+        freeze_support()
+        profiles = [ConfigProfile(**p_data) for p_data in conf.profiles]
+        matched = [profile for profile in profiles if args.profile in (profile.key, profile.folder)]
+        if len(matched) != 1:
+            parser.error(f"--profile {args.profile}: найдено профилей {len(matched)}, нужен ровно один")
+        failed = Backfill(matched[0], since=args.since, before=args.before, uid_from=args.uid_from,
+                          uid_to=args.uid_to, shard_size=args.shard_size, workers=args.workers).run()
+        if failed:
+            sys.exit(1)
+    else:
+        freeze_support()
+        # Один процесс на почтовый ящик: его профили делят IMAP-сессии и подключение к MongoDB
+        profiles = [ConfigProfile(**p_data) for p_data in conf.profiles]
+        list_proc = []
+        for group in ImapConnectionPool.group_profiles(profiles).values():
+            list_proc.append(multiprocessing.Process(target=run_account, args=(group,)))
 
-    for proc in list_proc:
-        proc.start()
-        time.sleep(5)
+        for proc in list_proc:
+            proc.start()
+        for proc in list_proc:
+            proc.join()
 
     log.info("Stop email module")
@@ -0,0 +1,65 @@
+from mail_logic.body_structure import BodyPart
+from mail_logic.imap_parser import parse_fetch_response
+
+TEXT_PLAIN = b'("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 120 4 NIL NIL NIL NIL)'
+TEXT_HTML = b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "BASE64" 2048 30 NIL NIL NIL NIL)'
+ATTACHMENT = (b'("APPLICATION" "PDF" ("NAME" "report.pdf") NIL NIL "BASE64" 90000 NIL '
+              b'("ATTACHMENT" ("FILENAME" "report.pdf")) NIL NIL)')
+
+
+def parse_structure(structure: bytes) -> BodyPart:
+    items, = parse_fetch_response([b"1 (UID 1 BODYSTRUCTURE " + structure + b")"])
+    return BodyPart.parse(items["BODYSTRUCTURE"])
+
+
+def test_alternative_with_attachment():
+    structure = parse_structure(b"((" + TEXT_PLAIN + TEXT_HTML + b' "ALTERNATIVE")' + ATTACHMENT + b' "MIXED")')
+
+    assert [(part.section, part.maintype, part.subtype) for part in structure.walk()] == [
+        ("", "multipart", "mixed"),
+        ("1", "multipart", "alternative"),
+        ("1.1", "text", "plain"),
+        ("1.2", "text", "html"),
+        ("2", "application", "pdf"),
+    ]
+    assert structure.find_body_part(force_to_image=False).section == "1.1"
+    assert structure.children[0].find_body_part(force_to_image=True).section == "1.2"
+
+    attachment, = structure.attachment_parts()
+    assert attachment.section == "2"
+    assert attachment.filename == "report.pdf"
+    assert attachment.size == 90000
+    assert attachment.encoding == "BASE64"
+
+
+def test_nil_fields():
+    structure = parse_structure(b'("TEXT" "PLAIN" NIL NIL NIL NIL NIL NIL NIL NIL NIL NIL)')
+
+    assert structure.section == "1"
+    assert structure.params == {}
+    assert structure.encoding is None
+    assert structure.size == 0
+    assert structure.disposition is None
+    assert structure.attachment_parts() == []
+
+
+def test_single_part_mail_body_is_section_1():
+    structure = parse_structure(TEXT_PLAIN)
+
+    assert not structure.is_multipart
+    assert structure.find_body_part(force_to_image=True).section == "1"
+    assert structure.params == {"charset": "utf-8"}
+
+
+def test_to_message_keeps_tree_and_fetched_payloads_only():
+    structure = parse_structure(b"((" + TEXT_PLAIN + TEXT_HTML + b' "ALTERNATIVE")' + ATTACHMENT + b' "MIXED")')
+
+    message = structure.to_message({"1.1": b"hello"})
+
+    parts = list(message.walk())
+    assert [part.get_content_type() for part in parts] == [
+        "multipart/mixed", "multipart/alternative", "text/plain", "text/html", "application/pdf"]
+    assert parts[2].get_payload() == "hello"
+    assert parts[2].get_content_charset() == "utf-8"
+    assert parts[3].get_payload() == ""
+    assert parts[4].get_filename() == "report.pdf"
@@ -0,0 +1,38 @@
+import pytest
+
+from mail_logic.filters import FilterEngine
+
+
+def make_filters(*subject_rules: str) -> FilterEngine:
+    return FilterEngine("@example.com", list(subject_rules), "test")
+
+
+@pytest.mark.parametrize("rules, subject, expected", [
+    # Левое совпадение в теме у "hello", но первым в конфиге идет "world"
+    (["world", "^re:", "hello"], "hello world", "world"),
+    (["world", "hello"], "Hello World", "world"),
+    (["^re:", "hello"], "RE: hello", "^re:"),
+    (["^re:", "hello"], "fwd: hello", "hello"),
+    (["^re:", "hello"], "fwd: bye", None),
+])
+def test_subject_rule_is_first_matching_rule_in_config_order(rules, subject, expected):
+    filters = make_filters(*rules)
+
+    assert filters.merged_subject_re is not None
+    assert filters._subject_rule(subject) == expected
+
+
+def test_not_mergeable_rules_are_checked_one_by_one():
+    filters = make_filters(r"(ab)\1", "x")
+
+    assert filters.merged_subject_re is None
+    assert filters._subject_rule("x abab") == r"(ab)\1"
+    assert filters._subject_rule("x") == "x"
+    assert filters._subject_rule("y") is None
+
+
+def test_no_subject_rules():
+    filters = make_filters()
+
+    assert filters.merged_subject_re is None
+    assert filters._subject_rule("anything") is None
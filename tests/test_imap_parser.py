@@ -0,0 +1,43 @@
+from mail_logic.imap_parser import get_uid, parse_fetch_response
+
+
+def test_literal_with_parentheses_does_not_break_nesting():
+    header = b"Subject: (re: ((draft)\r\nTo: a@example.com\r\n\r\n"
+    data = [(b"1 (UID 7 BODY[HEADER.FIELDS (TO SUBJECT)] {%d}" % len(header), header), b" FLAGS (\\Seen))"]
+
+    items, = parse_fetch_response(data)
+
+    assert get_uid(items) == 7
+    assert items["BODY[HEADER.FIELDS (TO SUBJECT)]"] == header
+    assert items["FLAGS"] == [b"\\Seen"]
+
+
+def test_several_messages_in_one_response():
+    data = [(b"1 (UID 10 BODY[1] {5}", b"hello"), b")",
+            (b"2 (UID 12 BODY[1] {3}", b")))"), b")"]
+
+    result = parse_fetch_response(data)
+
+    assert [(get_uid(items), items["BODY[1]"]) for items in result] == [(10, b"hello"), (12, b")))")]
+
+
+def test_nil_and_quoted_strings():
+    data = [b'3 (UID 5 BODY[2] NIL X-NAME "say \\"hi\\" (now)")']
+
+    items, = parse_fetch_response(data)
+
+    assert items["BODY[2]"] is None
+    assert items["X-NAME"] == b'say "hi" (now)'
+
+
+def test_nested_lists_are_parsed_to_python_lists():
+    data = [b'4 (UID 8 BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 12 1 NIL NIL NIL NIL))']
+
+    items, = parse_fetch_response(data)
+
+    assert items["BODYSTRUCTURE"] == [b"TEXT", b"PLAIN", [b"CHARSET", b"utf-8"], None, None, b"7BIT", b"12", b"1",
+                                      None, None, None, None]
+
+
+def test_untagged_lines_without_items_are_skipped():
+    assert parse_fetch_response([b"5 EXISTS", b"6 (UID 3)"]) == [{"UID": b"3"}]
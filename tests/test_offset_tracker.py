@@ -0,0 +1,58 @@
+from mail_logic.pipeline import OffsetTracker
+
+
+def test_offset_stops_at_first_unfinished_uid():
+    tracker = OffsetTracker(0)
+    tracker.start([1, 2, 3, 4])
+    tracker.fetched_up_to(4)
+
+    tracker.finish([3, 4])
+    assert tracker.committable() == 0
+    tracker.finish([1])
+    assert tracker.committable() == 1
+    tracker.finish([2])
+    assert tracker.committable() == 4
+
+
+def test_uid_gaps_do_not_hold_offset():
+    tracker = OffsetTracker(100)
+    tracker.start([105, 109])
+    tracker.fetched_up_to(120)
+
+    tracker.finish([109])
+    assert tracker.committable() == 104
+    tracker.finish([105])
+    assert tracker.committable() == 120
+
+
+def test_commit_writes_only_forward():
+    written = []
+    tracker = OffsetTracker(10)
+    tracker.start([11, 12])
+    tracker.fetched_up_to(12)
+
+    assert tracker.commit(written.append) is None
+    tracker.finish([12])
+    assert tracker.commit(written.append) is None
+    tracker.finish([11])
+    assert tracker.commit(written.append) == 12
+    assert tracker.commit(written.append) is None
+    assert written == [12]
+    assert tracker.committed_uid == 12
+
+
+def test_failed_write_keeps_committed_uid():
+    tracker = OffsetTracker(0)
+    tracker.start([1])
+    tracker.fetched_up_to(1)
+    tracker.finish([1])
+
+    def write(uid: int):
+        raise ConnectionError("db is down")
+
+    try:
+        tracker.commit(write)
+    except ConnectionError:
+        pass
+    assert tracker.committed_uid == 0
+    assert tracker.commit(lambda uid: None) == 1